@@ -10,13 +10,21 @@ NO WARRANTY, SOFTWARE IS PROVIDED 'AS IS'
 """
 
 import os
+import time
+import queue
 import shutil
 import logging
+import threading
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-from src.hikparser import HikParser
+from src.hikparser import HikParser, HikPagesWriter
+from src.hikcatalog import HikCatalogWriter, CATALOG_NAME
+from src.hikcarver import HikCarver
+from src.hikmetrics import HikMetrics
+from src.hikextractor import HikCancelled
 import subprocess
 
+METRICS_NAME = "HIKMetrics.json"
 
 def setup_logging():
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,6 +39,13 @@ def check_disk_space(required_space, output_dir):
         return False
     return True
 
+def reserve_space(parser, workers):
+    """
+    Free space kept by an extraction which checks the space per block:
+    HikExtractor._run_jobs has up to 2 * workers + 1 blocks in flight, plus the next one.
+    """
+    return (2 * workers + 2) * parser.master_sector.data_block_size
+
 def create_output_directory(directory):
     if not os.path.isdir(directory):
         os.makedirs(directory)
@@ -74,37 +89,175 @@ def list_physical_drives():
         logging.error("Failed to list physical drives: %s", e)
         return []
 
-def process_files(input_file, output_dir, mode):
-    try:
-        parser = HikParser(input_file)
-        logging.error("input_file: %s", input_file)
-        parser.read_master_sector()
-        logging.error("===================A")
-        parser.read_hikbtree()
-        logging.error("===================B")
-        parser.read_page_list()
-        logging.error("===================C")
-        parser.read_page_entries()
-        logging.error("===================D")
+def write_tables(parser, output_dir, rows=None, tables="csv"):
+    """ Writes the tables as CSV/text files ("csv"), as SQLite catalog ("sqlite") or both ("both")."""
+    if tables in ("csv", "both"):
         parser.print_hikpagelist(output_dir)
-        parser.print_hikpages(output_dir)
+        parser.print_hikpages(output_dir, rows)
         parser.print_master_sector(output_dir)
         parser.print_hikbtree(output_dir)
-        logging.error("===================")
+    if tables in ("sqlite", "both"):
+        parser.write_catalog(output_dir, rows)
+
+def open_table_writers(parser, output_dir, tables="csv"):
+    """
+    Streaming counterpart of write_tables: writes the tables without data blocks and returns the writers
+    of the data block tables, which tee_blocks fills while the tree is walked.
+    """
+    writers = []
+    if tables in ("csv", "both"):
+        parser.print_hikpagelist(output_dir)
+        parser.print_master_sector(output_dir)
+        parser.print_hikbtree(output_dir)
+        writers.append(HikPagesWriter(output_dir))
+    if tables in ("sqlite", "both"):
+        writers.append(HikCatalogWriter(parser, os.path.join(output_dir, CATALOG_NAME)))
+    return writers
+
+def tee_blocks(blocks, writers):
+    """ Yields the blocks after adding them to the table writers, tables and extraction share one walk."""
+    for block in blocks:
+        row = (block.page_index, block.block_index, block.channel, block.start_time, block.end_time,
+               block.data_offset)
+        for writer in writers:
+            writer.add_row(*row)
+        yield block
+
+
+def process_files(input_file, output_dir, mode, backend="file", workers=1, use_cache=True,
+                  channels=None, start_time=None, end_time=None, resume=True, incremental=False, carve=False,
+                  streaming=False, trim=None, observer=None, cancel_event=None, show_errors=True,
+                  tables="csv", stitch=None, max_run_blocks=None):
+    """
+    Parses the image, writes the tables and extracts the blocks (mode "e").
+    trim None trims the blocks only when they are stitched, see HikParser.extract_block.
+    observer receives the HikMetrics events, setting cancel_event stops the run between phases and chunks.
+    Errors are shown in a message box, or raised if show_errors is False.
+    """
+    metrics = HikMetrics()
+    if observer is not None:
+        metrics.add_observer(observer)
+
+    def check_cancelled():
+        if cancel_event is not None and cancel_event.is_set():
+            raise HikCancelled("Processing cancelled")
+
+    if trim is None:
+        trim = stitch is not None
+
+    parser = None
+    try:
+        logging.info("input_file: %s", input_file)
+        with metrics.phase("master_sector"):
+            parser = HikParser(input_file, backend, metrics)
+            parser.read_master_sector()
+        with metrics.phase("hikbtree_region"):
+            parser.load_hikbtree_region()
+        create_output_directory(output_dir)
+        if streaming and stitch is not None:
+            logging.info("Stitching orders the blocks by time, the whole tree is parsed first")
+            streaming = False
+        if streaming:
+            # Pages and blocks are decoded while the tables are written and the blocks extracted
+            with metrics.phase("hikbtree"):
+                parser.read_hikbtree()
+            with metrics.phase("page_list"):
+                parser.read_page_list()
+            with metrics.phase("write_tables"):
+                writers = open_table_writers(parser, output_dir, tables)
+            complete = False
+            try:
+                blocks = tee_blocks(parser.iter_blocks(), writers)
+                if mode == "e":
+                    # The block count is unknown before the tree is walked, the space is checked per block
+                    with metrics.phase("extract"):
+                        parser.extract_block(output_dir, workers, resume=resume, streaming=True, trim=trim,
+                                             cancel_event=cancel_event, blocks=blocks,
+                                             reserve_space=reserve_space(parser, workers))
+                else:
+                    with metrics.phase("write_tables"):
+                        for _ in blocks:
+                            check_cancelled()
+                complete = True
+            finally:
+                for writer in writers:
+                    writer.close(complete)
+            return
 
+        snapshot = parser.load_snapshot(output_dir) if incremental else None
+        with metrics.phase("metadata_cache"):
+            cached = use_cache and parser.load_metadata_cache(output_dir)
+        if not cached:
+            with metrics.phase("hikbtree"):
+                parser.read_hikbtree()
+            with metrics.phase("page_list"):
+                parser.read_page_list()
+            with metrics.phase("page_entries"):
+                parser.read_page_entries(workers, snapshot)
+            if use_cache:
+                with metrics.phase("metadata_cache"):
+                    parser.save_metadata_cache(output_dir)
+        check_cancelled()
+        rows = None
+        with metrics.phase("select"):
+            if channels is not None or start_time is not None or end_time is not None:
+                rows = parser.query_blocks(channels, start_time, end_time)
+                logging.info("%d of %d data blocks selected", len(rows), parser.get_total_blocks())
+        # The tables always list the whole selection, an incremental run only extracts the new blocks
+        with metrics.phase("write_tables"):
+            write_tables(parser, output_dir, rows, tables)
+        if snapshot is not None:
+            with metrics.phase("select"):
+                rows = parser.get_changed_blocks(snapshot, rows)
+                logging.info("%d new or changed data blocks since the last run", len(rows))
+        check_cancelled()
+
+        carved = []
+        if carve:
+            with metrics.phase("carve"):
+                carver = HikCarver(parser, workers, backend=backend)
+                carved = carver.scan()
+                carver.write_report(output_dir, carved)
 
         if mode == "e":
-            required_space = parser.get_total_blocks() * parser.master_sector.data_block_size
+            # Blocks the journal lists as complete need no space
+            pending = parser.get_pending_rows(output_dir, rows) if resume and stitch is None else rows
+            pending_blocks = parser.get_total_blocks() if pending is None else len(pending)
+            orphaned = [block for block in carved if not block.referenced]
+            required_space = (pending_blocks + len(orphaned)) * parser.master_sector.data_block_size
+            reserved_space = None
+            if trim and shutil.disk_usage(output_dir).free <= required_space:
+                # The trimmed lengths are only found while the blocks are copied, the full size is an upper
+                # bound. If that does not fit, the space is checked per block instead.
+                required_space = reserved_space = reserve_space(parser, workers)
             if check_disk_space(required_space, output_dir):
                 create_output_directory(output_dir)
-                parser.extract_block(output_dir)
+                with metrics.phase("extract"):
+                    parser.extract_block(output_dir, workers, rows=rows, resume=resume, trim=trim,
+                                         cancel_event=cancel_event, stitch=stitch, reserve_space=reserved_space,
+                                         max_run_blocks=max_run_blocks, append_manifest=incremental)
+                # Only extracted blocks count as seen, unselected ones stay new for the next run
+                if incremental:
+                    parser.save_snapshot(output_dir, rows, snapshot)
+                if orphaned:
+                    with metrics.phase("carve"):
+                        carver.extract(output_dir, orphaned, resume=resume, trim=trim, cancel_event=cancel_event,
+                                       reserve_space=reserved_space)
 
+    except HikCancelled:
+        logging.info("Processing cancelled")
+        if not show_errors:
+            raise
     except Exception as e:
         logging.error("Error processing files: %s", e)
+        if not show_errors:
+            raise
         messagebox.showerror("Error", f"Error processing files: {e}")
-    # finally:
-    #     if parser is not None:
-    #         parser.close()
+    finally:
+        if parser is not None:
+            parser.close()
+        if os.path.isdir(output_dir):
+            metrics.write_report(os.path.join(output_dir, METRICS_NAME))
 
 class Application(tk.Tk):
     def __init__(self):
@@ -135,6 +288,22 @@ class Application(tk.Tk):
         self.process_button = ttk.Button(self, text="Process", command=self.process_selected_drive)
         self.process_button.pack(pady=20)
 
+        self.cancel_button = ttk.Button(self, text="Cancel", command=self.cancel_processing, state="disabled")
+        self.cancel_button.pack(pady=5)
+
+        self.progress = ttk.Progressbar(self, length=400, mode="determinate")
+        self.progress.pack(pady=10)
+
+        self.status_var = tk.StringVar(value="Idle")
+        self.label_status = ttk.Label(self, textvariable=self.status_var)
+        self.label_status.pack(pady=5)
+
+        self.events = queue.Queue()
+        self.worker = None
+        self.cancel_event = None
+        self.extract_total = 0
+        self.extract_started = 0.0
+
     def select_output_directory(self):
         directory = filedialog.askdirectory()
         if directory:  # Khi một thư mục được chọn
@@ -152,14 +321,86 @@ class Application(tk.Tk):
             messagebox.showwarning("Warning", "Please select an output directory.")
             return
 
+        if self.worker is not None and self.worker.is_alive():
+            return
+
         # Log the selected drive and output directory for now
         logging.info(f"Selected drive: {selected_drive}")
         logging.info(f"Output directory: {output_dir}")
-        
-        # Cần thêm logic thực tế để xử lý ổ đĩa vật lý tại đây, ví dụ:
-        process_files(selected_drive, output_dir, "e")
-        # messagebox.showinfo("Info", "Processing started. This may take some time.")
+
+        # The extraction runs in a background thread, progress arrives through self.events
+        self.cancel_event = threading.Event()
+        self.worker = threading.Thread(target=self.run_worker, args=(selected_drive, output_dir, self.cancel_event),
+                                       daemon=True)
+        self.process_button.config(state="disabled")
+        self.cancel_button.config(state="normal")
+        self.progress["value"] = 0
+        self.extract_total = 0
+        self.extract_started = time.perf_counter()
+        self.status_var.set("Starting...")
+        self.worker.start()
+        self.after(200, self.poll_events)
+
+    def run_worker(self, selected_drive, output_dir, cancel_event):
+        try:
+            process_files(selected_drive, output_dir, "e", observer=lambda event, data: self.events.put((event, data)),
+                          cancel_event=cancel_event, show_errors=False)
+            self.events.put(("done", {}))
+        except HikCancelled:
+            self.events.put(("cancelled", {}))
+        except Exception as e:
+            self.events.put(("error", {"message": str(e)}))
+
+    def cancel_processing(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_button.config(state="disabled")
+            self.status_var.set("Cancelling...")
+
+    def poll_events(self):
+        finished = False
+        try:
+            while True:
+                event, data = self.events.get_nowait()
+                finished = self.handle_event(event, data) or finished
+        except queue.Empty:
+            pass
+        if finished:
+            self.process_button.config(state="normal")
+            self.cancel_button.config(state="disabled")
+        else:
+            self.after(200, self.poll_events)
+
+    def handle_event(self, event, data):
+        """ Updates the status from one worker event, returns True if the worker has finished."""
+        if event == "phase_start":
+            self.status_var.set("Phase: {}".format(data["phase"]))
+        elif event == "extract_start":
+            self.extract_total = data["total_blocks"]
+            self.extract_started = time.perf_counter()
+            self.progress["maximum"] = max(1, self.extract_total)
+        elif event in ("block_extracted", "block_skipped"):
+            done = data["blocks_extracted"] + data["blocks_skipped"]
+            seconds = time.perf_counter() - self.extract_started
+            rate = data["bytes_written"] / seconds / (1024 * 1024) if seconds else 0.0
+            status = "Blocks: {} / {}  {:.1f} MB/s".format(done, self.extract_total or "?", rate)
+            if data["blocks_extracted"] and self.extract_total:
+                eta = (self.extract_total - done) * seconds / data["blocks_extracted"]
+                status += "  ETA: {}".format(time.strftime("%H:%M:%S", time.gmtime(eta)))
+            self.progress["value"] = done
+            self.status_var.set(status)
+        elif event == "done":
+            self.status_var.set("Finished")
+            return True
+        elif event == "cancelled":
+            self.status_var.set("Cancelled")
+            return True
+        elif event == "error":
+            self.status_var.set("Error")
+            messagebox.showerror("Error", "Error processing files: {}".format(data["message"]))
+            return True
+        return False
 
 if __name__ == "__main__":
     app = Application()
-    app.mainloop()
\ No newline at end of file
+    app.mainloop()
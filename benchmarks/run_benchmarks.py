@@ -0,0 +1,220 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.hikparser import HikParser
+from benchmarks.synthetic import write_synthetic_image
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# name: (pages, blocks per page, block size, blocks to extract)
+SCALES = {
+    "small": (8, 64, 256 * 1024, 64),
+    "medium": (64, 256, 256 * 1024, 256),
+    "large": (256, 1024, 256 * 1024, 512),
+}
+
+
+# Measurements shorter than this in the baseline are reported but not gated, their noise exceeds any tolerance
+MIN_GATE_SECONDS = 0.005
+
+
+def measure(samples, name, func):
+    """ Runs func and adds its wall time to the samples of name, returns the result of func."""
+    start = time.perf_counter()
+    value = func()
+    samples.setdefault(name, []).append(time.perf_counter() - start)
+    return value
+
+
+def summarize(samples, amounts):
+    """
+    Best time of the repeated runs per measurement, the minimum is the run least disturbed by other load.
+    amounts maps names to (amount, unit) for a throughput next to the time.
+    """
+    results = {}
+    for name, times in samples.items():
+        seconds = min(times)
+        result = {"seconds": seconds}
+        if name in amounts:
+            amount, unit = amounts[name]
+            result[unit] = amount / seconds if seconds else float("inf")
+        results[name] = result
+    return results
+
+
+def run_scale(name, work_dir, backend, repeat=5):
+    pages, blocks_per_page, block_size, extract_blocks = SCALES[name]
+    image = os.path.join(work_dir, name + ".dd")
+    layout = write_synthetic_image(image, pages, blocks_per_page, block_size)
+    output_dir = os.path.join(work_dir, name + "_out")
+    os.makedirs(output_dir)
+    rows = range(min(extract_blocks, layout["blocks"]))
+
+    samples = {}
+    # The parse steps fill the parser, every run starts with a new one
+    for _ in range(repeat):
+        parser = HikParser(image, backend)
+        measure(samples, "read_master_sector", parser.read_master_sector)
+        measure(samples, "load_hikbtree_region", parser.load_hikbtree_region)
+        measure(samples, "read_hikbtree", parser.read_hikbtree)
+        measure(samples, "read_page_list", parser.read_page_list)
+        measure(samples, "read_page_entries", parser.read_page_entries)
+        measure(samples, "print_hikpagelist", lambda: parser.print_hikpagelist(output_dir))
+        measure(samples, "print_hikpages", lambda: parser.print_hikpages(output_dir))
+        measure(samples, "extract_block", lambda: parser.extract_block(output_dir, rows=rows, resume=False))
+        parser.close()
+    shutil.rmtree(output_dir)
+    os.remove(image)
+    return summarize(samples, {
+        "load_hikbtree_region": (layout["hikbtree_size"] / (1024 * 1024), "MB/s"),
+        "read_page_list": (layout["pages"], "pages/s"),
+        "read_page_entries": (layout["blocks"], "entries/s"),
+        "print_hikpagelist": (layout["pages"], "rows/s"),
+        "print_hikpages": (layout["blocks"], "rows/s"),
+        "extract_block": (len(rows) * block_size / (1024 * 1024), "MB/s"),
+    })
+
+
+def page_cache_size():
+    """ Bytes in the page cache (Linux), None where unknown."""
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("Cached:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def drop_from_cache(path):
+    """ Evicts the image from the page cache, so every backend starts cold."""
+    if hasattr(os, "posix_fadvise"):
+        with open(path, "rb") as file:
+            os.fsync(file.fileno())
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def run_backends(name, work_dir, backends):
+    """ A/B run: extracts the same blocks of one image with every backend, measures throughput and cache growth."""
+    pages, blocks_per_page, block_size, extract_blocks = SCALES[name]
+    image = os.path.join(work_dir, name + ".dd")
+    layout = write_synthetic_image(image, pages, blocks_per_page, block_size)
+    rows = range(min(extract_blocks, layout["blocks"]))
+    samples = {}
+    cache_growth = {}
+    for backend in backends:
+        output_dir = os.path.join(work_dir, "{}_{}_out".format(name, backend))
+        os.makedirs(output_dir)
+        parser = HikParser(image, backend)
+        parser.read_master_sector()
+        parser.read_hikbtree()
+        parser.read_page_list()
+        parser.read_page_entries()
+        drop_from_cache(image)
+        cached = page_cache_size()
+        # One cold run per backend, a repeated run would read from the page cache
+        measure(samples, backend, lambda: parser.extract_block(output_dir, rows=rows, resume=False))
+        if cached is not None:
+            cache_growth[backend] = (page_cache_size() - cached) / (1024 * 1024)
+        parser.close()
+        shutil.rmtree(output_dir)
+    os.remove(image)
+    results = summarize(samples, {backend: (len(rows) * block_size / (1024 * 1024), "MB/s") for backend in backends})
+    for backend, growth in cache_growth.items():
+        results[backend]["MB cached"] = growth
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds=MIN_GATE_SECONDS):
+    """
+    Prints every measurement next to the baseline, returns the names of regressions.
+    Measurements below min_seconds in the baseline are not gated.
+    """
+    regressions = []
+    for scale, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            reference = baseline.get(scale, {}).get(name)
+            line = "{:<8} {:<20} {:>10.4f} s".format(scale, name, result["seconds"])
+            for unit, value in result.items():
+                if unit != "seconds":
+                    line += "  {:>14.1f} {}".format(value, unit)
+            if reference:
+                ratio = result["seconds"] / reference["seconds"] if reference["seconds"] else 1.0
+                line += "  ({:.2f}x baseline)".format(ratio)
+                if reference["seconds"] < min_seconds:
+                    line += " not gated"
+                elif ratio > 1 + tolerance:
+                    regressions.append("{}/{}".format(scale, name))
+            print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic HIKVISION images")
+    parser.add_argument("-s", "--scale", action="append", choices=sorted(SCALES),
+                        help="Scale to run, can be repeated (default: small and medium)")
+    parser.add_argument("-b", "--backend", default="file", help="Reader backend (file, mmap or direct)")
+    parser.add_argument("-d", "--dir", default=None, help="Directory for the images (default: temp directory)")
+    parser.add_argument("--ab", nargs="+", metavar="BACKEND",
+                        help="Compare the extraction of the given backends instead of running the benchmarks")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Runs per measurement, the best one counts")
+    parser.add_argument("--min-seconds", type=float, default=MIN_GATE_SECONDS,
+                        help="Measurements shorter than this in the baseline are not gated")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    scales = args.scale or ["small", "medium"]
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    if args.ab:
+        try:
+            results = {scale: run_backends(scale, work_dir, args.ab) for scale in scales}
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        compare(results, {}, args.tolerance)
+        return 0
+    try:
+        results = {scale: run_scale(scale, work_dir, args.backend, args.repeat) for scale in scales}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.isfile(BASELINE):
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(BASELINE, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print("Baseline written to {}".format(BASELINE))
+    elif regressions:
+        print("Slower than baseline: {}".format(", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
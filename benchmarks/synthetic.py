@@ -0,0 +1,109 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import struct
+import random
+
+# The layouts read by HikParser, the generator can not drift from the parser
+from src.hikparser import (MASTER_SECTOR_OFFSET, MASTER_SECTOR, HIKBTREE_HEADER, PAGE_LIST_HEADER, PAGE_LIST_ENTRY,
+                           PAGE_HEADER_SIZE, DATA_BLOCK_ENTRY, UNUSED_ENTRY)
+
+HIKBTREE_OFFSET = 1024 * 1024
+PAGE_LIST_OFFSET = HIKBTREE_OFFSET + 512
+FIRST_PAGE_OFFSET = HIKBTREE_OFFSET + 4096
+ALIGNMENT = 1024 * 1024
+START_TIME = 1600000000
+BLOCK_DURATION = 600
+
+# MPEG-2 pack header and the start of a video PES packet
+PS_PACK = b"\x00\x00\x01\xba\x44\x00\x04\x00\x04\x01\x01\x89\xc3\xf8"
+PES_HEADER = b"\x00\x00\x01\xe0"
+PES_PAYLOAD = 4096
+
+
+def _align(value, alignment):
+    return -(-value // alignment) * alignment
+
+
+def _stream(size, seed):
+    """ size bytes of program stream: pack header followed by PES packets."""
+    parts = [PS_PACK]
+    filled = len(PS_PACK)
+    fill = bytes([seed % 251]) * PES_PAYLOAD
+    while filled + 6 + PES_PAYLOAD <= size:
+        parts.append(PES_HEADER + struct.pack('>H', PES_PAYLOAD) + fill)
+        filled += 6 + PES_PAYLOAD
+    return b"".join(parts)
+
+
+def write_synthetic_image(path, pages=16, blocks_per_page=64, block_size=1024 * 1024, channels=4,
+                          payload_size=64 * 1024, orphans=0, seed=0):
+    """
+    Writes a sparse HIKVISION image to path and returns its layout.
+    Master sector, HIKBTree, page list and pages are complete; every data block starts with payload_size
+    bytes of program stream followed by stale bytes, the rest of the block is a hole.
+    Block offsets are shuffled over the pages like on a recorder that reuses blocks.
+    orphans adds data blocks with video which no page references.
+    """
+    rng = random.Random(seed)
+    total_blocks = pages * blocks_per_page
+    page_size = _align(PAGE_HEADER_SIZE + DATA_BLOCK_ENTRY.size * (blocks_per_page + 1), 512)
+    page_offsets = [FIRST_PAGE_OFFSET + page * page_size for page in range(pages)]
+    hikbtree_size = FIRST_PAGE_OFFSET - HIKBTREE_OFFSET + pages * page_size
+    data_area_offset = _align(HIKBTREE_OFFSET + hikbtree_size, ALIGNMENT)
+    data_block_total = total_blocks + orphans
+    disk_size = data_area_offset + data_block_total * block_size
+
+    order = list(range(total_blocks))
+    rng.shuffle(order)
+    with open(path, "wb") as file:
+        file.truncate(disk_size)
+        file.seek(MASTER_SECTOR_OFFSET)
+        file.write(MASTER_SECTOR.pack(b"HIKVISION@HANGZHOU".ljust(32, b"\0"), disk_size, 0, 0, data_area_offset,
+                                      block_size, data_block_total, HIKBTREE_OFFSET, hikbtree_size, 0, 0,
+                                      START_TIME))
+        file.seek(HIKBTREE_OFFSET)
+        file.write(HIKBTREE_HEADER.pack(b"HIKBTREE", START_TIME, 0, PAGE_LIST_OFFSET, FIRST_PAGE_OFFSET))
+        file.seek(PAGE_LIST_OFFSET)
+        file.write(PAGE_LIST_HEADER.pack(page_offsets[0], page_offsets[1] if pages > 1 else 0))
+
+        for page, page_offset in enumerate(page_offsets):
+            numbers = order[page * blocks_per_page:(page + 1) * blocks_per_page]
+            entries = []
+            for number in numbers:
+                start_time = START_TIME + number * BLOCK_DURATION
+                entries.append(DATA_BLOCK_ENTRY.pack(0, 1, number % channels + 1, start_time,
+                                                     start_time + BLOCK_DURATION - 1,
+                                                     data_area_offset + number * block_size))
+            if page > 0:
+                next_page = page_offsets[page + 1] if page + 1 < pages else 0
+                first = min(numbers)
+                file.seek(page_offset)
+                file.write(PAGE_LIST_ENTRY.pack(page % channels + 1, START_TIME + first * BLOCK_DURATION,
+                                                START_TIME + (max(numbers) + 1) * BLOCK_DURATION - 1,
+                                                data_area_offset + first * block_size, next_page))
+            file.seek(page_offset + PAGE_HEADER_SIZE)
+            file.write(b"".join(entries) + struct.pack('<Q', UNUSED_ENTRY))
+
+        payload_size = min(payload_size, block_size)
+        stale = b"\xaa" * min(4096, block_size - payload_size)
+        for number in range(data_block_total):
+            file.seek(data_area_offset + number * block_size)
+            file.write(_stream(payload_size, number) + stale)
+
+    return {
+        "disk_size": disk_size,
+        "pages": pages,
+        "blocks": total_blocks,
+        "block_size": block_size,
+        "data_area_offset": data_area_offset,
+        "hikbtree_size": hikbtree_size,
+    }
@@ -0,0 +1,126 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import asyncio
+import weakref
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .hikparser import HikParser
+from .hikextractor import HikExtractor, plan_extraction
+
+
+class AsyncHikParser:
+    """
+    asyncio interface to HikParser.
+    All blocking reads run on a bounded thread pool, so the event loop keeps running and
+    several images can be processed in one loop. Create instances with AsyncHikParser.open.
+    """
+
+    def __init__(self, parser, executor, own_executor=False):
+        self.parser = parser
+        self.executor = executor
+        self.own_executor = own_executor
+        # Open extract_blocks iterators, closed before the executor is shut down
+        self.generators = weakref.WeakSet()
+
+    @classmethod
+    async def open(cls, filename, backend="file", max_workers=4, executor=None):
+        """ Opens the image. Without an executor a private pool of max_workers threads is used."""
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        loop = asyncio.get_running_loop()
+        parser = await loop.run_in_executor(executor, HikParser, filename, backend)
+        return cls(parser, executor, own_executor)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def read_master_sector(self):
+        await self._run(self.parser.read_master_sector)
+
+    async def load_hikbtree_region(self):
+        await self._run(self.parser.load_hikbtree_region)
+
+    async def read_hikbtree(self):
+        await self._run(self.parser.read_hikbtree)
+
+    async def read_page_list(self):
+        await self._run(self.parser.read_page_list)
+
+    async def read_page_entries(self, workers=1):
+        await self._run(self.parser.read_page_entries, workers)
+
+    async def read_metadata(self, workers=1):
+        """ Reads master sector, HIKBTree, page list and page entries."""
+        await self.read_master_sector()
+        await self.load_hikbtree_region()
+        await self.read_hikbtree()
+        await self.read_page_list()
+        await self.read_page_entries(workers)
+
+    async def query_blocks(self, channels=None, start_time=None, end_time=None):
+        return await self._run(self.parser.query_blocks, channels, start_time, end_time)
+
+    def extract_blocks(self, dir, rows=None, max_pending=2, order="offset", **settings):
+        """
+        Async iterator over extracted blocks, yields (data block entry, file name) per block.
+        At most max_pending blocks are copied ahead of the consumer, a slow consumer pauses the extraction.
+        When the consumer stops early, copies not yet started are dropped. close closes open iterators.
+        settings are passed on to HikExtractor (method, hash_algorithms, resume, ...).
+        """
+        generator = self._extract_blocks(dir, rows, max_pending, order, settings)
+        self.generators.add(generator)
+        return generator
+
+    async def _extract_blocks(self, dir, rows, max_pending, order, settings):
+        parser = self.parser
+        extractor = HikExtractor(parser, **settings)
+        if rows is None:
+            rows = range(len(parser.block_table))
+        plan = plan_extraction(parser.block_table, rows, parser.master_sector.data_block_size, order)
+
+        def extract(row):
+            block = parser.block_table.get_entry(row)
+            return block, extractor.extract_entry(dir, block)
+
+        await self._run(extractor.start, dir)
+        pending = deque()
+        try:
+            for run in plan.runs:
+                for row in run:
+                    if len(pending) >= max_pending:
+                        yield await asyncio.wrap_future(pending.popleft())
+                    pending.append(self.executor.submit(extract, row))
+            while pending:
+                yield await asyncio.wrap_future(pending.popleft())
+        finally:
+            # Drop copies not yet started, let running ones finish before the manifest and journal are closed
+            running = [future for future in pending if not future.cancel()]
+            if running:
+                await asyncio.gather(*(asyncio.wrap_future(future) for future in running), return_exceptions=True)
+            # Closing the files does not block, it must not depend on the executor still running
+            extractor.finish()
+
+    async def close(self):
+        for generator in list(self.generators):
+            await generator.aclose()
+        await self._run(self.parser.close)
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,86 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+from array import array
+from .hikdatablockentry import HikDataBlockEntry
+
+
+class HikBlockTable:
+    """
+    Columnar table of all data block entries.
+    Every column is a typed array, row i describes the i-th data block in page order.
+    """
+
+    def __init__(self):
+        self.existence_of_file = array('Q')
+        self.channel = array('H')
+        self.start_time = array('I')
+        self.end_time = array('I')
+        self.data_offset = array('Q')
+        # Index of the page in the page list and 1-based position of the block inside its page
+        self.page_index = array('I')
+        self.block_index = array('I')
+
+    def __len__(self):
+        return len(self.data_offset)
+
+    def __str__(self):
+        return "Data blocks: {}".format(len(self))
+
+    def __repr__(self):
+        return self.__str__()
+
+    def clear(self):
+        self.__init__()
+
+    def append_page(self, page_index, records):
+        """
+        Appends the decoded entries of one page.
+        records are (unused, existence_of_file, channel, start_time, end_time, data_offset) tuples.
+        Returns the row of the first appended entry.
+        """
+        first = len(self)
+        count = len(records)
+        if count:
+            _, existence_of_file, channel, start_time, end_time, data_offset = zip(*records)
+            self.existence_of_file.extend(existence_of_file)
+            self.channel.extend(channel)
+            self.start_time.extend(start_time)
+            self.end_time.extend(end_time)
+            self.data_offset.extend(data_offset)
+            self.page_index.extend([page_index] * count)
+            self.block_index.extend(range(1, count + 1))
+        return first
+
+    def get_entry(self, row):
+        data_block = HikDataBlockEntry()
+        data_block.existence_of_file = self.existence_of_file[row]
+        data_block.channel = self.channel[row]
+        data_block.start_time = self.start_time[row]
+        data_block.end_time = self.end_time[row]
+        data_block.data_offset = self.data_offset[row]
+        data_block.page_index = self.page_index[row]
+        data_block.block_index = self.block_index[row]
+        return data_block
+
+    def get_entries(self, first, count):
+        return [self.get_entry(row) for row in range(first, first + count)]
+
+    def iter_rows(self, rows=None):
+        """
+        Yields (page_index, block_index, channel, start_time, end_time, data_offset) per row,
+        for all rows or only the given ones.
+        """
+        if rows is None:
+            return zip(self.page_index, self.block_index, self.channel,
+                       self.start_time, self.end_time, self.data_offset)
+        return ((self.page_index[row], self.block_index[row], self.channel[row],
+                 self.start_time[row], self.end_time[row], self.data_offset[row]) for row in rows)
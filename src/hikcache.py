@@ -0,0 +1,269 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import os
+import sys
+import struct
+import hashlib
+import logging
+from array import array
+from .hikpageentry import HikPageEntry
+
+CACHE_MAGIC = b"HIKCACHE"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct('<8sI')
+CACHE_KEY = struct.Struct('<Qq20s')
+MASTER_SECTOR_FIELDS = ('hdd_cap', 'sys_log_offset', 'sys_log_size', 'video_data_area_offset', 'data_block_size',
+                        'data_block_total', 'hikbtree1_offset', 'hikbtree1_size', 'hikbtree2_offset',
+                        'hikbtree2_size')
+HIKBTREE_FIELDS = ('footer_offset', 'page_list_offset', 'page_one_offset')
+PAGE_COLUMNS = (('offset_to_page', 'Q'), ('channel', 'H'), ('start_time', 'I'), ('end_time', 'I'),
+                ('data_offset', 'Q'), ('first_block', 'Q'), ('block_count', 'Q'))
+BLOCK_COLUMNS = ('existence_of_file', 'channel', 'start_time', 'end_time', 'data_offset',
+                 'page_index', 'block_index')
+SEEN_MAGIC = b"HIKSEEN_"
+SEEN_COLUMNS = (('channel', 'H'), ('start_time', 'I'), ('end_time', 'I'), ('data_offset', 'Q'))
+
+
+class CacheMismatch(Exception):
+    pass
+
+
+def cache_file_name(cache_dir, image_path):
+    """ Cache sidecar for the given image inside cache_dir."""
+    name = hashlib.sha1(os.path.abspath(image_path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "HIKMetadata-{}.cache".format(name))
+
+
+def image_key(parser):
+    """
+    Identity of the image: absolute path, size, modification time and SHA-1 of the HIKBTree region.
+    The master sector and the HIKBTree region have to be read before.
+    """
+    if parser.hikbtree_region is None:
+        parser.load_hikbtree_region()
+    try:
+        mtime = os.stat(parser.disk_name).st_mtime_ns
+    except OSError:
+        mtime = 0
+    region_hash = hashlib.sha1(parser.hikbtree_region).digest()
+    return os.path.abspath(parser.disk_name), parser.file_obj.get_size(), mtime, region_hash
+
+
+def _write_str(file, value):
+    data = str(value).encode("utf-8")
+    file.write(struct.pack('<I', len(data)))
+    file.write(data)
+
+
+def _read_exact(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise CacheMismatch("truncated cache file")
+    return data
+
+
+def _read_str(file):
+    size = struct.unpack('<I', _read_exact(file, 4))[0]
+    return _read_exact(file, size).decode("utf-8")
+
+
+def _write_array(file, values):
+    file.write(struct.pack('<cQ', values.typecode.encode("ascii"), len(values)))
+    values.tofile(file)
+
+
+def _read_array(file):
+    typecode, count = struct.unpack('<cQ', _read_exact(file, 9))
+    values = array(typecode.decode("ascii"))
+    values.frombytes(_read_exact(file, count * values.itemsize))
+    return values
+
+
+def save_metadata(parser, path):
+    """ Writes master sector, HIKBTree, page list and block table of a parsed image to path."""
+    key_path, size, mtime, region_hash = image_key(parser)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION))
+        _write_str(file, sys.byteorder)
+        _write_str(file, key_path)
+        file.write(CACHE_KEY.pack(size, mtime, region_hash))
+
+        master_sector = parser.master_sector
+        _write_str(file, master_sector.signatur)
+        _write_str(file, master_sector.init_time)
+        file.write(struct.pack('<{}Q'.format(len(MASTER_SECTOR_FIELDS)),
+                               *(getattr(master_sector, name) for name in MASTER_SECTOR_FIELDS)))
+
+        hikbtree = parser.hikbtree
+        _write_str(file, hikbtree.signatur)
+        _write_str(file, hikbtree.created_time)
+        file.write(struct.pack('<{}Q'.format(len(HIKBTREE_FIELDS)),
+                               *(getattr(hikbtree, name) for name in HIKBTREE_FIELDS)))
+
+        pages = hikbtree.get_page_list()
+        for name, typecode in PAGE_COLUMNS:
+            _write_array(file, array(typecode, (getattr(page, name) for page in pages)))
+
+        for name in BLOCK_COLUMNS:
+            _write_array(file, getattr(parser.block_table, name))
+    os.replace(tmp_path, path)
+    logging.info("Metadata written to %s", path)
+
+
+class HikSnapshot:
+    """ Image key, HIKBTree, page list and block table columns of an earlier parse."""
+
+    def __init__(self, key, master_values, hikbtree_strings, hikbtree_values, page_columns, block_columns):
+        self.key = key
+        self.master_values = master_values
+        self.hikbtree_strings = hikbtree_strings
+        self.hikbtree_values = hikbtree_values
+        self.page_columns = dict(zip((name for name, _ in PAGE_COLUMNS), page_columns))
+        self.block_columns = dict(zip(BLOCK_COLUMNS, block_columns))
+        self.pages = None
+        # Keys of the blocks extracted so far, see load_seen_blocks
+        self.seen = set()
+
+    def get_page_records(self, page):
+        """
+        Entries of the page as (unused, existence_of_file, channel, start_time, end_time, data_offset) records
+        if the snapshot holds the page with identical page list values, otherwise None.
+        """
+        if self.pages is None:
+            columns = self.page_columns
+            self.pages = {}
+            for values in zip(columns['offset_to_page'], columns['channel'], columns['start_time'],
+                              columns['end_time'], columns['data_offset'], columns['first_block'],
+                              columns['block_count']):
+                self.pages[values[:5]] = values[5:]
+        block_range = self.pages.get((page.offset_to_page, page.channel, page.start_time, page.end_time,
+                                      page.data_offset))
+        if block_range is None:
+            return None
+        first, count = block_range
+        columns = self.block_columns
+        return list(zip([0] * count,
+                        columns['existence_of_file'][first:first + count],
+                        columns['channel'][first:first + count],
+                        columns['start_time'][first:first + count],
+                        columns['end_time'][first:first + count],
+                        columns['data_offset'][first:first + count]))
+
+    def contains_block(self, table, row):
+        """ True if the block of the table row was extracted by an earlier incremental run, see save_seen_blocks."""
+        return block_key(table, row) in self.seen
+
+
+def block_key(table, row):
+    """ Channel, times and offset identifying the block of a table row across parses."""
+    return table.channel[row], table.start_time[row], table.end_time[row], table.data_offset[row]
+
+
+def save_seen_blocks(path, keys):
+    """ Writes the block_key of every extracted block to path."""
+    keys = sorted(keys)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(CACHE_HEADER.pack(SEEN_MAGIC, CACHE_VERSION))
+        _write_str(file, sys.byteorder)
+        for column, (_, typecode) in enumerate(SEEN_COLUMNS):
+            _write_array(file, array(typecode, (key[column] for key in keys)))
+    os.replace(tmp_path, path)
+
+
+def load_seen_blocks(path):
+    """ Block keys written by save_seen_blocks, an empty set if there are none or they can not be read."""
+    if not os.path.isfile(path):
+        return set()
+    try:
+        with open(path, "rb") as file:
+            magic, version = CACHE_HEADER.unpack(_read_exact(file, CACHE_HEADER.size))
+            if magic != SEEN_MAGIC or version != CACHE_VERSION or _read_str(file) != sys.byteorder:
+                raise CacheMismatch("unknown format")
+            columns = [_read_array(file) for _ in SEEN_COLUMNS]
+    except (CacheMismatch, OSError, struct.error, UnicodeDecodeError, ValueError) as e:
+        logging.info("Extracted blocks %s not used: %s", path, e)
+        return set()
+    return set(zip(*columns))
+
+
+def read_snapshot(path):
+    """ Reads a metadata file written by save_metadata, raises CacheMismatch if it is not usable."""
+    try:
+        with open(path, "rb") as file:
+            magic, version = CACHE_HEADER.unpack(_read_exact(file, CACHE_HEADER.size))
+            if magic != CACHE_MAGIC or version != CACHE_VERSION or _read_str(file) != sys.byteorder:
+                raise CacheMismatch("unknown cache format")
+            key = (_read_str(file),) + CACHE_KEY.unpack(_read_exact(file, CACHE_KEY.size))
+
+            _read_str(file)
+            _read_str(file)
+            master_values = struct.unpack('<{}Q'.format(len(MASTER_SECTOR_FIELDS)),
+                                          _read_exact(file, 8 * len(MASTER_SECTOR_FIELDS)))
+            hikbtree_strings = (_read_str(file), _read_str(file))
+            hikbtree_values = struct.unpack('<{}Q'.format(len(HIKBTREE_FIELDS)),
+                                            _read_exact(file, 8 * len(HIKBTREE_FIELDS)))
+            page_columns = [_read_array(file) for _ in PAGE_COLUMNS]
+            block_columns = [_read_array(file) for _ in BLOCK_COLUMNS]
+    except (struct.error, UnicodeDecodeError, ValueError) as e:
+        raise CacheMismatch(str(e))
+    return HikSnapshot(key, master_values, hikbtree_strings, hikbtree_values, page_columns, block_columns)
+
+
+def load_snapshot(path):
+    """ Snapshot stored at path, None if there is none or it can not be read."""
+    if not os.path.isfile(path):
+        return None
+    try:
+        return read_snapshot(path)
+    except (CacheMismatch, OSError) as e:
+        logging.info("Snapshot %s not used: %s", path, e)
+        return None
+
+
+def load_metadata(parser, path):
+    """
+    Restores HIKBTree, page list and block table from path if the cache belongs to the image.
+    The master sector has to be read before. Returns False if there is no valid cache.
+    """
+    if not os.path.isfile(path):
+        return False
+    try:
+        snapshot = read_snapshot(path)
+        if snapshot.key != image_key(parser):
+            raise CacheMismatch("image changed")
+        if snapshot.master_values != tuple(getattr(parser.master_sector, name) for name in MASTER_SECTOR_FIELDS):
+            raise CacheMismatch("master sector changed")
+    except CacheMismatch as e:
+        logging.info("Metadata cache %s not used: %s", path, e)
+        return False
+
+    hikbtree = parser.hikbtree
+    hikbtree.signatur, hikbtree.created_time = snapshot.hikbtree_strings
+    for name, value in zip(HIKBTREE_FIELDS, snapshot.hikbtree_values):
+        setattr(hikbtree, name, value)
+
+    table = parser.block_table
+    table.clear()
+    for name in BLOCK_COLUMNS:
+        setattr(table, name, snapshot.block_columns[name])
+
+    hikbtree.page_list = []
+    columns = snapshot.page_columns
+    for values in zip(*(columns[name] for name, _ in PAGE_COLUMNS)):
+        page = HikPageEntry()
+        page.offset_to_page, page.channel, page.start_time, page.end_time, page.data_offset = values[:5]
+        page.set_block_range(table, values[5], values[6])
+        hikbtree.add_hikpage(page)
+    logging.info("Metadata loaded from cache %s", path)
+    return True
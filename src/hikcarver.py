@@ -0,0 +1,175 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from .hikreader import open_reader
+from .hikstream import HIKVISION_HEADER, PS_PACK_HEADER, PROBE_SIZE, read_scr
+from .hikextractor import HikExtractor
+from .hikdatablockentry import HikDataBlockEntry
+
+CARVED_MANIFEST_NAME = "HIKCarvedManifest.csv"
+
+
+def probe_block(data):
+    """
+    Looks for a stream header at the start of a data block.
+    Returns (header, position, scr) or None if the probe holds no video stream.
+    """
+    if data[:4] == HIKVISION_HEADER:
+        pos = data.find(PS_PACK_HEADER)
+        return "IMKH", 0, read_scr(data, pos) if pos >= 0 else None
+    pos = data.find(PS_PACK_HEADER)
+    if pos < 0:
+        return None
+    return "PS", pos, read_scr(data, pos)
+
+
+def _carve_shard(filename, backend, video_data_area_offset, data_block_size, first, last, probe_size):
+    """ Probes the data blocks first..last-1, runs in a worker process with its own reader."""
+    hits = []
+    with open_reader(filename, backend) as reader:
+        for number in range(first, last):
+            offset = video_data_area_offset + number * data_block_size
+            data = bytes(reader.read_at(offset, min(probe_size, data_block_size)))
+            if not data:
+                break
+            found = probe_block(data)
+            if found is not None:
+                hits.append((number, offset) + found)
+    return hits
+
+
+class HikCarvedBlock:
+    __slots__ = ('number', 'offset', 'header', 'header_pos', 'scr', 'referenced')
+
+    def __init__(self, number, offset, header, header_pos, scr, referenced):
+        self.number = number
+        self.offset = offset
+        self.header = header
+        self.header_pos = header_pos
+        self.scr = scr
+        self.referenced = referenced
+
+    def __str__(self):
+        return ("Data block: {}".format(self.number) + "\n" +
+                "Offset: {}".format(self.offset) + "\n" +
+                "Header: {} at {}".format(self.header, self.header_pos) + "\n" +
+                "Referenced by HIKBTree: {}".format(self.referenced) + "\n")
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class HikCarvedExtractor(HikExtractor):
+    """
+    Extracts carved blocks as carved_<block number>.mp4 with the digests, journal, resume, trim and cancel
+    of HikExtractor. A carved block is handed over as a data block entry without page and channel,
+    its block index is the number of the block in the video data area.
+    """
+
+    def block_file_name(self, block):
+        return "carved_{}".format(block.block_index)
+
+    def describe_block(self, block):
+        return "Carved block {}".format(block.block_index)
+
+    def extract(self, dir, blocks):
+        """ Extracts the given carved blocks in the order of their offsets."""
+        entries = []
+        for block in sorted(blocks, key=lambda block: block.offset):
+            entry = HikDataBlockEntry()
+            entry.data_offset = block.offset
+            entry.block_index = block.number
+            entry.page_index = -1
+            entries.append(entry)
+        self.parser.metrics.notify("extract_start", total_blocks=len(entries),
+                                   total_bytes=len(entries) * self.parser.master_sector.data_block_size)
+        self.start(dir)
+        try:
+            self._run_jobs(self.extract_entry, dir, entries)
+        finally:
+            self.finish()
+
+    def open_manifest(self, dir):
+        self.manifest = open(os.path.join(dir, CARVED_MANIFEST_NAME), "w", newline="")
+        self.manifest.write(";".join(("File", "Datablock", "Offset", "Size", "Blocksize")
+                                     + self.hash_algorithms) + "\n")
+
+    def write_manifest(self, block, fileName, size, digests, skipped=False):
+        if self.manifest is None:
+            return
+        output = ";".join([
+            os.path.basename(fileName),
+            str(block.block_index),
+            str(block.data_offset),
+            str(size),
+            str(self.parser.master_sector.data_block_size)
+        ] + [digests[name] for name in self.hash_algorithms])
+        with self.manifest_lock:
+            self.manifest.write(output + "\n")
+            self.manifest.flush()
+
+
+class HikCarver:
+    """
+    Sweeps the video data area block by block and looks for video streams.
+    Blocks holding a stream but missing in the block table are orphaned footage.
+    The block range is split into shards which are probed by a process pool.
+    """
+
+    def __init__(self, parser, workers=1, probe_size=PROBE_SIZE, backend="file"):
+        self.parser = parser
+        self.workers = max(1, workers)
+        self.probe_size = probe_size
+        self.backend = backend
+
+    def scan(self, first=0, last=None):
+        """ Probes data blocks first..last-1 (the whole data area by default) and returns the hits."""
+        master_sector = self.parser.master_sector
+        if last is None:
+            last = master_sector.data_block_total
+        args = (self.parser.disk_name, self.backend, master_sector.video_data_area_offset,
+                master_sector.data_block_size)
+
+        if self.workers == 1:
+            hits = _carve_shard(*args, first, last, self.probe_size)
+        else:
+            shard = max(1, -(-(last - first) // (self.workers * 4)))
+            bounds = [(start, min(start + shard, last)) for start in range(first, last, shard)]
+            hits = []
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(_carve_shard, *args, start, end, self.probe_size)
+                           for start, end in bounds]
+                for future in futures:
+                    hits.extend(future.result())
+
+        referenced = set(self.parser.block_table.data_offset)
+        blocks = [HikCarvedBlock(*hit, hit[1] in referenced) for hit in hits]
+        logging.info("Carving: %d of %d data blocks hold video, %d are not referenced",
+                     len(blocks), last - first, sum(not block.referenced for block in blocks))
+        return blocks
+
+    def write_report(self, dir, blocks):
+        with open(os.path.join(dir, "HIKCarved.csv"), "w", newline="") as file:
+            file.write("Datablock;Offset;Header;Headerposition;SCR;Referenced\n")
+            for block in blocks:
+                file.write("{};{};{};{};{};{}\n".format(block.number, block.offset, block.header, block.header_pos,
+                                                        "" if block.scr is None else block.scr,
+                                                        int(block.referenced)))
+
+    def extract(self, dir, blocks, hash_algorithms=("md5",), resume=True, trim=False, cancel_event=None,
+                reserve_space=None):
+        """ Extracts the given carved blocks into dir as carved_<block number>.mp4, see HikCarvedExtractor."""
+        extractor = HikCarvedExtractor(self.parser, self.workers, hash_algorithms=hash_algorithms, resume=resume,
+                                       trim=trim, cancel_event=cancel_event, reserve_space=reserve_space)
+        extractor.extract(dir, blocks)
@@ -0,0 +1,138 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import os
+import sqlite3
+import logging
+from itertools import islice
+from .hikcache import MASTER_SECTOR_FIELDS, HIKBTREE_FIELDS
+
+CATALOG_NAME = "HIKCatalog.db"
+# Rows passed to one executemany call
+CATALOG_BATCH = 65536
+
+# Times are UNIX timestamps (UTC), the views add them formatted like the CSV tables
+SCHEMA = """
+CREATE TABLE master_sector (signature TEXT, init_time TEXT, {master_sector});
+CREATE TABLE hikbtree (signature TEXT, created_time TEXT, {hikbtree});
+CREATE TABLE pages (page INTEGER PRIMARY KEY, channel INTEGER, start_time INTEGER, end_time INTEGER,
+                    offset INTEGER, data_offset INTEGER);
+CREATE TABLE blocks (page INTEGER, datablock INTEGER, channel INTEGER, start_time INTEGER, end_time INTEGER,
+                     offset INTEGER, PRIMARY KEY (page, datablock)) WITHOUT ROWID;
+CREATE VIEW page_times AS
+    SELECT page, channel, datetime(start_time, 'unixepoch') AS starttime,
+           datetime(end_time, 'unixepoch') AS endtime, offset FROM pages;
+CREATE VIEW block_times AS
+    SELECT page, datablock, channel, datetime(start_time, 'unixepoch') AS starttime,
+           datetime(end_time, 'unixepoch') AS endtime, offset FROM blocks;
+""".format(master_sector=", ".join("{} INTEGER".format(name) for name in MASTER_SECTOR_FIELDS),
+           hikbtree=", ".join("{} INTEGER".format(name) for name in HIKBTREE_FIELDS))
+
+# Created after the rows are inserted, building an index once is faster than updating it per row
+INDEXES = (
+    "CREATE INDEX blocks_channel_time ON blocks (channel, start_time, end_time)",
+    "CREATE INDEX blocks_time ON blocks (start_time, end_time)",
+    "CREATE INDEX blocks_offset ON blocks (offset)",
+    "CREATE INDEX pages_channel_time ON pages (channel, start_time, end_time)",
+)
+
+
+def _insert_batches(connection, statement, rows):
+    count = 0
+    while True:
+        batch = list(islice(rows, CATALOG_BATCH))
+        if not batch:
+            return count
+        connection.executemany(statement, batch)
+        count += len(batch)
+
+
+class HikCatalogWriter:
+    """
+    Writes a new SQLite catalog at path: master sector, HIKBTree and pages when opened,
+    the data blocks row by row, so the catalog can be filled while the blocks are streamed.
+    The file is renamed only when closed complete, a crash leaves no half written catalog behind.
+    """
+
+    def __init__(self, parser, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self.rows = []
+        self.blocks = 0
+        self.connection = sqlite3.connect(self.tmp_path, isolation_level=None)
+        try:
+            self.connection.execute("PRAGMA journal_mode = OFF")
+            self.connection.execute("PRAGMA synchronous = OFF")
+            self.connection.executescript(SCHEMA)
+            self.connection.execute("BEGIN")
+
+            master_sector = parser.master_sector
+            values = (master_sector.signatur, master_sector.init_time,
+                      *(getattr(master_sector, name) for name in MASTER_SECTOR_FIELDS))
+            self.connection.execute("INSERT INTO master_sector VALUES ({})".format(", ".join("?" * len(values))),
+                                    values)
+            hikbtree = parser.hikbtree
+            values = (hikbtree.signatur, hikbtree.created_time,
+                      *(getattr(hikbtree, name) for name in HIKBTREE_FIELDS))
+            self.connection.execute("INSERT INTO hikbtree VALUES ({})".format(", ".join("?" * len(values))), values)
+
+            _insert_batches(self.connection, "INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                            ((i, page.channel, page.start_time, page.end_time, page.offset_to_page, page.data_offset)
+                             for i, page in enumerate(parser.iter_pages(), 1)))
+        except BaseException:
+            self.close(complete=False)
+            raise
+
+    def add_row(self, page_index, block_index, channel, start_time, end_time, data_offset):
+        self.rows.append((page_index + 1, block_index, channel, start_time, end_time, data_offset))
+        if len(self.rows) >= CATALOG_BATCH:
+            self._insert_rows()
+
+    def _insert_rows(self):
+        self.connection.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)", self.rows)
+        self.blocks += len(self.rows)
+        self.rows.clear()
+
+    def close(self, complete=True):
+        """ Indexes and renames a complete catalog, an incomplete one is removed. Returns the written blocks."""
+        try:
+            if complete:
+                self._insert_rows()
+                for statement in INDEXES:
+                    self.connection.execute(statement)
+                self.connection.execute("COMMIT")
+                self.connection.execute("ANALYZE")
+        finally:
+            self.connection.close()
+        if not complete:
+            os.remove(self.tmp_path)
+            return self.blocks
+        os.replace(self.tmp_path, self.path)
+        logging.info("Catalog with %d data blocks written to %s", self.blocks, self.path)
+        return self.blocks
+
+
+def write_catalog(parser, path, rows=None):
+    """
+    Writes master sector, HIKBTree, pages and data blocks (in rows, all if None) of a parsed image
+    into a new SQLite database at path. Returns the number of written data blocks.
+    """
+    writer = HikCatalogWriter(parser, path)
+    complete = False
+    try:
+        for row in parser.iter_block_rows(rows):
+            writer.add_row(*row)
+        complete = True
+    finally:
+        blocks = writer.close(complete)
+    return blocks
@@ -0,0 +1,246 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import os
+import sys
+import zlib
+import struct
+import logging
+import argparse
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+from .hikreader import HikPositionalReader
+
+GZIP_MAGIC = b"\x1f\x8b"
+GZIP_WBITS = 31
+# Uncompressed size of every gzip member written by compress_image
+COMPRESS_CHUNK_SIZE = 4 * 1024 * 1024
+# Decompressed chunks kept by HikGzipReader
+CHUNK_CACHE_BYTES = 64 * 1024 * 1024
+# Members larger than this can not be decompressed at random, the image has to be recompressed
+MAX_CHUNK_SIZE = 256 * 1024 * 1024
+INDEX_SUFFIX = ".hikidx"
+INDEX_MAGIC = b"HIKGZIDX"
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<8sIQqQ')
+READ_SIZE = 1024 * 1024
+
+
+def is_gzip(filename):
+    """ True if filename is a regular file starting with the gzip magic."""
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as file:
+        return file.read(2) == GZIP_MAGIC
+
+
+def build_chunk_index(filename):
+    """
+    Decompresses the whole file once and returns the start offsets of its gzip members as two arrays,
+    (uncompressed offsets, compressed offsets), each with the end of the last member appended.
+    Stops with ValueError as soon as a member grows beyond MAX_CHUNK_SIZE.
+    """
+    uncompressed = array('Q', [0])
+    compressed = array('Q', [0])
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    total = 0
+    with open(filename, 'rb') as file:
+        data = file.read(READ_SIZE)
+        while True:
+            # Bounded output, sparse images compress by orders of magnitude
+            output = decompressor.decompress(data, READ_SIZE)
+            total += len(output)
+            if total - uncompressed[-1] > MAX_CHUNK_SIZE:
+                # A single member image would otherwise be inflated completely before it is rejected
+                raise ValueError("{} has a gzip member of more than {} bytes, recompress it with compress_image"
+                                 .format(filename, MAX_CHUNK_SIZE))
+            if decompressor.eof:
+                data = decompressor.unused_data
+                uncompressed.append(total)
+                compressed.append(file.tell() - len(data))
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                if data[:len(GZIP_MAGIC)] != GZIP_MAGIC[:len(data)]:
+                    # Padding behind the last member
+                    break
+                data = data or file.read(READ_SIZE)
+                if not data:
+                    break
+            elif decompressor.unconsumed_tail:
+                data = decompressor.unconsumed_tail
+            else:
+                data = file.read(READ_SIZE)
+                # Without new input the decompressor may still hold output of the read input
+                if not data and not output:
+                    break
+    if len(compressed) == 1 or total != uncompressed[-1]:
+        raise ValueError("{} ends inside a gzip member".format(filename))
+    return uncompressed, compressed
+
+
+def _file_key(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def save_chunk_index(filename, uncompressed, compressed):
+    path = filename + INDEX_SUFFIX
+    size, mtime = _file_key(filename)
+    try:
+        with open(path + ".tmp", 'wb') as file:
+            file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, size, mtime, len(uncompressed)))
+            for column in (uncompressed, compressed):
+                if sys.byteorder != "little":
+                    column = array('Q', column)
+                    column.byteswap()
+                column.tofile(file)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logging.info("Chunk index %s not written: %s", path, e)
+
+
+def load_chunk_index(filename):
+    """ Chunk index cached next to the image, None if there is none or the image changed since."""
+    path = filename + INDEX_SUFFIX
+    try:
+        with open(path, 'rb') as file:
+            magic, version, size, mtime, count = INDEX_HEADER.unpack(file.read(INDEX_HEADER.size))
+            if (magic, version) != (INDEX_MAGIC, INDEX_VERSION) or (size, mtime) != _file_key(filename):
+                return None
+            uncompressed = array('Q')
+            compressed = array('Q')
+            uncompressed.fromfile(file, count)
+            compressed.fromfile(file, count)
+    except (OSError, EOFError, struct.error):
+        return None
+    if sys.byteorder != "little":
+        uncompressed.byteswap()
+        compressed.byteswap()
+    return uncompressed, compressed
+
+
+class HikGzipReader(HikPositionalReader):
+    """
+    Reads an image compressed as a series of gzip members, see compress_image.
+    The member offsets are indexed once and cached next to the image (INDEX_SUFFIX),
+    a read only decompresses the members it covers. Decompressed members are kept in an LRU
+    cache of cache_bytes, so parsing the metadata touches only a few of them.
+    """
+
+    def __init__(self, filename, cache_bytes=CHUNK_CACHE_BYTES):
+        super().__init__(filename)
+        index = load_chunk_index(filename)
+        if index is None:
+            logging.info("Building chunk index of %s", filename)
+            index = build_chunk_index(filename)
+            save_chunk_index(filename, *index)
+        self.uncompressed, self.compressed = index
+        largest = max(end - start for start, end in zip(self.uncompressed, self.uncompressed[1:]))
+        if largest > MAX_CHUNK_SIZE:
+            raise ValueError("{} has a gzip member of {} bytes, recompress it with compress_image"
+                             .format(filename, largest))
+        self.size = self.uncompressed[-1]
+        self.file_obj = open(filename, 'rb')
+        self.cache_bytes = cache_bytes
+        self.chunks = OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+
+    def read_at(self, offset, num_bytes):
+        parts = []
+        end = min(offset + num_bytes, self.size)
+        while offset < end:
+            index = bisect_right(self.uncompressed, offset) - 1
+            start = self.uncompressed[index]
+            part = self._get_chunk(index)[offset - start:end - start]
+            if not part:
+                break
+            parts.append(part)
+            offset += len(part)
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+    def _get_chunk(self, index):
+        with self.lock:
+            chunk = self.chunks.get(index)
+            if chunk is not None:
+                self.chunks.move_to_end(index)
+                return chunk
+        start, end = self.compressed[index], self.compressed[index + 1]
+        data = os.pread(self.file_obj.fileno(), end - start, start) if hasattr(os, 'pread') else \
+            self._read_locked(start, end - start)
+        chunk = zlib.decompress(data, GZIP_WBITS)
+        with self.lock:
+            if index not in self.chunks:
+                self.chunks[index] = chunk
+                self.cached_bytes += len(chunk)
+            while self.cached_bytes > self.cache_bytes and len(self.chunks) > 1:
+                _, evicted = self.chunks.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+        return chunk
+
+    def _read_locked(self, offset, num_bytes):
+        with self.lock:
+            self.file_obj.seek(offset)
+            return self.file_obj.read(num_bytes)
+
+    def get_size(self):
+        return self.size
+
+    def close(self):
+        self.chunks.clear()
+        self.cached_bytes = 0
+        self.file_obj.close()
+
+
+def compress_image(source, target, chunk_size=COMPRESS_CHUNK_SIZE, level=6):
+    """
+    Compresses source into target as one gzip member per chunk_size bytes, target stays a valid
+    .gz file for gzip/zcat. The chunk index is written next to target.
+    """
+    uncompressed = array('Q', [0])
+    compressed = array('Q', [0])
+    with open(source, 'rb') as src, open(target + ".tmp", 'wb') as dst:
+        while True:
+            data = src.read(chunk_size)
+            if not data:
+                break
+            compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+            dst.write(compressor.compress(data))
+            dst.write(compressor.flush())
+            uncompressed.append(uncompressed[-1] + len(data))
+            compressed.append(dst.tell())
+    os.replace(target + ".tmp", target)
+    save_chunk_index(target, uncompressed, compressed)
+    logging.info("%s compressed into %s: %d chunks, %d of %d bytes", source, target, len(uncompressed) - 1,
+                 compressed[-1], uncompressed[-1])
+    return target
+
+
+def main():
+    """ python -m src.hikcompressed image.dd image.dd.gz"""
+    parser = argparse.ArgumentParser(description="Compresses an image into a seekable gzip file")
+    parser.add_argument("source", help="Image (.dd or .001)")
+    parser.add_argument("target", help="Compressed image (.gz)")
+    parser.add_argument("-c", "--chunk-size", type=int, default=COMPRESS_CHUNK_SIZE,
+                        help="Uncompressed bytes per gzip member")
+    parser.add_argument("-l", "--level", type=int, default=6, help="Compression level")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    compress_image(args.source, args.target, args.chunk_size, args.level)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
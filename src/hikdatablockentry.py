@@ -11,6 +11,9 @@ NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
 
 class HikDataBlockEntry:
 
+    __slots__ = ('unused', 'existence_of_file', 'channel', 'start_time', 'end_time',
+                 'data_offset', 'unknown', 'start_end_time', 'page_index', 'block_index')
+
     def __init__(self):
         self.unused = 0
         self.existence_of_file = 0
@@ -19,6 +22,9 @@ class HikDataBlockEntry:
         self.end_time = 0
         self.data_offset = 0
         self.unknown = 0
+        # Position in the page list and 1-based position inside the page
+        self.page_index = 0
+        self.block_index = 0
 
     def __str__(self):
         return ("File exsists: {}".format(self.existence_of_file) + "\n" +
@@ -0,0 +1,431 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import io
+import os
+import errno
+import shutil
+import logging
+import threading
+from .hikhasher import HikHasher
+from .hikjournal import HikJournal
+from .hikstream import find_stream_end
+from .hikindex import format_time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+CHUNK_SIZE = 1024 * 1024
+# Errors telling that a kernel copy call is not supported for the given files
+KERNEL_COPY_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+MANIFEST_NAME = "HIKManifest.csv"
+
+
+class HikExtractionPlan:
+    """
+    Order in which the data blocks are read from the image.
+    Blocks lying directly behind each other are grouped into runs which are read sequentially.
+    """
+
+    def __init__(self, runs, seek_distance, naive_seek_distance):
+        self.runs = runs
+        self.seek_distance = seek_distance
+        self.naive_seek_distance = naive_seek_distance
+
+    def __str__(self):
+        return ("Blocks: {}".format(sum(len(run) for run in self.runs)) + "\n" +
+                "Sequential runs: {}".format(len(self.runs)) + "\n" +
+                "Seek distance: {}".format(self.seek_distance) + "\n" +
+                "Seek distance in page order: {}".format(self.naive_seek_distance) + "\n")
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def seek_distance(offsets, block_size, start=0):
+    """ Sum of head movements needed to read blocks of block_size at the given offsets in order."""
+    distance = 0
+    pos = start
+    for offset in offsets:
+        distance += abs(offset - pos)
+        pos = offset + block_size
+    return distance
+
+
+def plan_extraction(table, rows, block_size, order="offset", start=0, max_run_blocks=None):
+    """
+    Plans the extraction of the given block table rows.
+    order is "page" (B-tree order), "offset" (ascending physical offset) or "elevator"
+    (sweep upwards from start, then downwards for the blocks below start).
+    Runs are split after max_run_blocks blocks, so several workers can share a long run.
+    """
+    rows = list(rows)
+    offsets = table.data_offset
+    naive = seek_distance((offsets[row] for row in rows), block_size, start)
+
+    if order == "offset":
+        rows.sort(key=offsets.__getitem__)
+    elif order == "elevator":
+        rows.sort(key=offsets.__getitem__)
+        lower = [row for row in rows if offsets[row] < start]
+        rows = [row for row in rows if offsets[row] >= start] + lower[::-1]
+    elif order != "page":
+        raise ValueError("Unknown extraction order: {}".format(order))
+
+    runs = []
+    end = None
+    for row in rows:
+        if offsets[row] == end and len(runs[-1]) != max_run_blocks:
+            runs[-1].append(row)
+        else:
+            runs.append([row])
+        end = offsets[row] + block_size
+
+    planned = seek_distance((offsets[row] for row in rows), block_size, start)
+    return HikExtractionPlan(runs, planned, naive)
+
+
+class HikCancelled(Exception):
+    pass
+
+
+class HikExtractor:
+    """
+    Copies data blocks from the image into the output directory.
+    Blocks are distributed over a pool of workers, so reading, hashing and writing
+    of different blocks overlap. The number of chunk buffers in flight is bounded.
+    Sequential runs are split after max_run_blocks blocks, by default into one share per worker.
+
+    method "read" copies through user space, "kernel" moves the bytes inside the kernel
+    with copy_file_range or sendfile and falls back to "read" where they are not supported.
+
+    The digests of all configured hash_algorithms are computed in the same read pass and
+    written together with the block details into one manifest file in the output directory.
+
+    Blocks are written under a temporary ".part" name and recorded in a journal once complete.
+    With resume, blocks the journal lists as complete are skipped.
+    With append_manifest the rows are added to the manifest of an earlier run, as in incremental runs which
+    only extract the new blocks. A block listed before is not repeated unless it is extracted again, the
+    later row then supersedes the earlier one.
+
+    With trim only the valid stream at the start of each block is copied, see find_stream_end.
+    The stream is walked and copied in the same pass, payload_sizes may map data offsets to already
+    known trimmed sizes.
+
+    With reserve_space every block is only started while the output disk has that many bytes free,
+    otherwise the extraction stops with ENOSPC. It guards runs whose total size is not known up front.
+
+    Setting cancel_event (a threading.Event) stops the extraction with HikCancelled after the current chunk.
+    """
+
+    def __init__(self, parser, workers=1, max_buffers=None, chunk_size=CHUNK_SIZE, max_run_blocks=None,
+                 method="read", hash_algorithms=("md5",), resume=True, trim=False, payload_sizes=None,
+                 cancel_event=None, reserve_space=None, append_manifest=False):
+        if method not in ("read", "kernel"):
+            raise ValueError("Unknown extraction method: {}".format(method))
+        self.parser = parser
+        self.max_run_blocks = max_run_blocks
+        self.reader = parser.file_obj
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self.buffers = threading.BoundedSemaphore(max_buffers or 2 * self.workers)
+        self.method = method
+        self.hash_algorithms = tuple(hash_algorithms)
+        self.manifest = None
+        self.manifest_lock = threading.Lock()
+        self.append_manifest = append_manifest
+        self.manifest_files = set()
+        self.resume = resume
+        self.journal = None
+        self.trim = trim
+        self.payload_sizes = payload_sizes or {}
+        self.cancel_event = cancel_event
+        self.reserve_space = reserve_space
+        self.use_copy_file_range = hasattr(os, 'copy_file_range')
+        self.use_sendfile = hasattr(os, 'sendfile')
+
+    def extract(self, dir, rows=None, order="offset"):
+        """
+        Extracts the given block table rows, all blocks if rows is None.
+        The blocks are read in the order planned by plan_extraction, output names do not change.
+        """
+        table = self.parser.block_table
+        if rows is None:
+            rows = range(len(table))
+        max_run_blocks = self.max_run_blocks
+        if max_run_blocks is None and self.workers > 1:
+            # Adjacent blocks would form one run, which only one worker reads
+            max_run_blocks = -(-len(rows) // self.workers) or None
+        plan = plan_extraction(table, rows, self.parser.master_sector.data_block_size, order,
+                               max_run_blocks=max_run_blocks)
+        logging.info("Extraction plan: %d runs, seek distance %d bytes (page order: %d bytes)",
+                     len(plan.runs), plan.seek_distance, plan.naive_seek_distance)
+
+        total_blocks = sum(len(run) for run in plan.runs)
+        self.parser.metrics.notify("extract_start", total_blocks=total_blocks,
+                                   total_bytes=total_blocks * self.parser.master_sector.data_block_size)
+        self.start(dir)
+        try:
+            self._run_jobs(self.extract_run, dir, plan.runs)
+        finally:
+            self.finish()
+        return plan
+
+    def extract_stream(self, dir, blocks):
+        """
+        Extracts data block entries as they arrive, e.g. from HikParser.iter_blocks.
+        Blocks are handed to the workers in the given order while the iterable is still producing.
+        """
+        self.start(dir)
+        try:
+            self._run_jobs(self.extract_entry, dir, blocks)
+        finally:
+            self.finish()
+
+    def start(self, dir):
+        """ Opens manifest and journal of an extraction into dir."""
+        self.open_manifest(dir)
+        self.journal = HikJournal(dir)
+
+    def finish(self):
+        self.close_manifest()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def _run_jobs(self, job, dir, items):
+        if self.workers == 1:
+            for item in items:
+                job(dir, item)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            for item in items:
+                # Keep the queue short instead of submitting every item at once
+                if len(pending) >= 2 * self.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(job, dir, item))
+            for future in pending:
+                future.result()
+
+    def open_manifest(self, dir):
+        path = os.path.join(dir, MANIFEST_NAME)
+        header = ";".join(("File", "Page", "Datablock", "Channel", "Starttime", "Endtime",
+                           "Offset", "Size", "Blocksize") + self.hash_algorithms) + "\n"
+        self.manifest_files = set()
+        if self.append_manifest and os.path.isfile(path):
+            with open(path, "rb") as file:
+                data = file.read()
+            # A row torn by a crash is cut off, the block is listed again below
+            data = data[:data.rfind(b"\n") + 1]
+            lines = data.decode().splitlines(True)
+            if lines and lines[0] == header:
+                self.manifest_files = set(line.split(";", 1)[0] for line in lines[1:])
+                with open(path, "r+b") as file:
+                    file.truncate(len(data))
+                self.manifest = open(path, "a", newline="")
+                return
+            logging.warning("Manifest %s has other columns and is rewritten", path)
+        self.manifest = open(path, "w", newline="")
+        self.manifest.write(header)
+
+    def close_manifest(self):
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+
+    def write_manifest(self, block, fileName, size, digests, skipped=False):
+        if self.manifest is None:
+            return
+        if skipped and os.path.basename(fileName) in self.manifest_files:
+            # Listed by an earlier run with the digests of the journal
+            return
+        output = ";".join([
+            os.path.basename(fileName),
+            str(block.page_index + 1),
+            str(block.block_index),
+            str(block.channel),
+            format_time(block.start_time),
+            format_time(block.end_time),
+            str(block.data_offset),
+            str(size),
+            str(self.parser.master_sector.data_block_size)
+        ] + [digests[name] for name in self.hash_algorithms])
+        with self.manifest_lock:
+            self.manifest.write(output + "\n")
+            self.manifest.flush()
+
+    def extract_run(self, dir, run):
+        """ Extracts blocks which follow each other on the disk, the image is read sequentially."""
+        for row in run:
+            self.extract_row(dir, row)
+
+    def extract_row(self, dir, row):
+        return self.extract_entry(dir, self.parser.block_table.get_entry(row))
+
+    def block_file_name(self, block):
+        """ Output file name (without extension) of a data block."""
+        return self.parser.block_file_name(block)
+
+    def describe_block(self, block):
+        return "Block {} of page {}".format(block.block_index, block.page_index + 1)
+
+    def payload_size(self, block):
+        """ Number of bytes to copy for the block, the trimmed stream length with trim."""
+        length = self.parser.master_sector.data_block_size
+        if not self.trim:
+            return length
+        size = self.payload_sizes.get(block.data_offset)
+        if size is None:
+            size = find_stream_end(self.reader, block.data_offset, length)
+        return size
+
+    def check_space(self, dir):
+        if self.reserve_space is not None and shutil.disk_usage(dir).free < self.reserve_space:
+            logging.error("Insufficient hard disk space! Less than %d bytes free in %s", self.reserve_space, dir)
+            raise OSError(errno.ENOSPC, "Insufficient hard disk space, extraction stopped")
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise HikCancelled("Extraction cancelled")
+
+    def extract_entry(self, dir, block):
+        self.check_cancelled()
+        fileName = os.path.join(dir, self.block_file_name(block)) + ".mp4"
+
+        if self.resume and self.journal is not None:
+            completed = self.journal.get_completed(fileName, self.hash_algorithms)
+            if completed is not None:
+                size, digests = completed
+                self.write_manifest(block, fileName, size, digests, skipped=True)
+                self.parser.metrics.block_skipped(block, size)
+                logging.debug("%s already extracted", self.describe_block(block))
+                return fileName
+
+        self.check_space(dir)
+        # An interrupted block leaves only its .part file, which is truncated and rewritten
+        partName = fileName + ".part"
+        hasher = HikHasher(self.hash_algorithms, metrics=self.parser.metrics)
+        try:
+            with open(partName, 'wb') as f2:
+                # The kernel copy needs the length up front, a stream still to be walked is copied by read
+                if self.method == "kernel" and (not self.trim or block.data_offset in self.payload_sizes):
+                    offset = block.data_offset
+                    length = self.payload_size(block)
+                    copied = self.copy_kernel(f2, offset, length)
+                    if self.hash_algorithms:
+                        # The bytes never passed through user space, hash them in a second pass
+                        self.hash_range(hasher, offset, copied)
+                    self.copy_range(f2, offset + copied, length - copied, hasher)
+                    # Drop preallocated space which was not filled
+                    f2.truncate(f2.tell())
+                else:
+                    self.copy_block(f2, block, hasher)
+                size = f2.tell()
+                f2.flush()
+                os.fsync(f2.fileno())
+        finally:
+            digests = hasher.hexdigests()
+        os.replace(partName, fileName)
+        if self.journal is not None:
+            self.journal.record(fileName, size, digests)
+        self.write_manifest(block, fileName, size, digests)
+        self.parser.metrics.block_extracted(block, size)
+        logging.debug("%s extracted", self.describe_block(block))
+        return fileName
+
+    def copy_block(self, f2, block, hasher):
+        """
+        Copies the block, only its valid stream with trim, to the current position of f2 and returns the
+        bytes copied. A stream without known size is walked and copied in one pass, every byte is read once.
+        """
+        if not self.trim or block.data_offset in self.payload_sizes:
+            return self.copy_range(f2, block.data_offset, self.payload_size(block), hasher)
+        start = f2.tell()
+
+        def write(data):
+            self.check_cancelled()
+            f2.write(data)
+            if self.hash_algorithms:
+                hasher.update(data)
+
+        find_stream_end(self.reader, block.data_offset, self.parser.master_sector.data_block_size, write)
+        return f2.tell() - start
+
+    def copy_range(self, f2, offset, length, hasher):
+        """ Copies length bytes at offset of the image to the current position of f2, returns the bytes copied."""
+        copied = 0
+        while copied < length:
+            self.check_cancelled()
+            with self.buffers:
+                data = self.reader.read_at(offset + copied, min(self.chunk_size, length - copied))
+                if not data:
+                    break
+                f2.write(data)
+            if self.hash_algorithms:
+                hasher.update(data)
+            copied += len(data)
+        return copied
+
+    def copy_kernel(self, f2, offset, length):
+        """
+        Copies length bytes at offset of the image into the empty output file f2 without passing them
+        through user space. Returns the number of bytes copied, the caller copies the rest.
+        """
+        try:
+            src_fd = self.reader.fileno()
+        except (io.UnsupportedOperation, AttributeError):
+            return 0
+        dst_fd = f2.fileno()
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(dst_fd, 0, length)
+            except OSError:
+                pass
+
+        copied = 0
+        while copied < length:
+            self.check_cancelled()
+            count = min(length - copied, self.chunk_size)
+            sent = None
+            if self.use_copy_file_range:
+                try:
+                    sent = os.copy_file_range(src_fd, dst_fd, count, offset + copied)
+                except OSError as e:
+                    if e.errno not in KERNEL_COPY_UNSUPPORTED:
+                        raise
+                    self.use_copy_file_range = False
+            if sent is None and self.use_sendfile:
+                try:
+                    sent = os.sendfile(dst_fd, src_fd, offset + copied, count)
+                except OSError as e:
+                    if e.errno not in KERNEL_COPY_UNSUPPORTED:
+                        raise
+                    self.use_sendfile = False
+            if not sent:
+                break
+            self.parser.metrics.count_read(sent)
+            copied += sent
+        # Keep the file object in sync with the descriptor written by the kernel
+        f2.seek(copied)
+        return copied
+
+    def hash_range(self, hasher, offset, length):
+        while length:
+            self.check_cancelled()
+            with self.buffers:
+                data = self.reader.read_at(offset, min(self.chunk_size, length))
+                if not data:
+                    break
+            hasher.update(data)
+            offset += len(data)
+            length -= len(data)
@@ -0,0 +1,65 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import time
+import queue
+import hashlib
+import threading
+
+HASH_ALGORITHMS = ("md5", "sha1", "sha256", "blake2b")
+
+
+class HikHasher:
+    """
+    Computes several digests of a stream in one pass on a background thread.
+    Chunks are handed over through a queue with two slots, so hashing of one chunk
+    overlaps the read of the next. hashlib releases the GIL while hashing large chunks.
+    """
+
+    def __init__(self, algorithms=("md5",), depth=2, metrics=None):
+        for name in algorithms:
+            if name not in HASH_ALGORITHMS:
+                raise ValueError("Unsupported hash algorithm: {}".format(name))
+        self.hashes = [(name, hashlib.new(name)) for name in algorithms]
+        self.error = None
+        self.metrics = metrics
+        self.seconds = 0.0
+        self.queue = queue.Queue(depth)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is not None:
+                continue
+            start = time.perf_counter()
+            try:
+                for _, hash_obj in self.hashes:
+                    hash_obj.update(data)
+            except Exception as e:
+                self.error = e
+            self.seconds += time.perf_counter() - start
+
+    def update(self, data):
+        self.queue.put(data)
+
+    def hexdigests(self):
+        """ Finishes the stream and returns a dict algorithm -> hex digest."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.metrics is not None:
+            self.metrics.count_hash_time(self.seconds)
+        if self.error is not None:
+            raise self.error
+        return {name: hash_obj.hexdigest() for name, hash_obj in self.hashes}
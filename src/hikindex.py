@@ -0,0 +1,124 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import datetime
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+
+EPOCH = datetime.datetime(1970, 1, 1)
+SECONDS_PER_DAY = 86400
+
+
+def to_timestamp(value):
+    """ Converts a datetime (naive values are UTC, like all times in the tables) or a number to a UNIX timestamp."""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int(value.timestamp())
+    return int(value)
+
+
+@lru_cache(maxsize=4096)
+def _format_day(day):
+    return (EPOCH + datetime.timedelta(days=day)).strftime('%d.%m.%Y')
+
+
+def format_time(timestamp):
+    """
+    Same as utcfromtimestamp(timestamp).strftime('%d.%m.%Y %H:%M:%S'), but the date part is formatted
+    only once per day, blocks of a recording share few days.
+    """
+    day, seconds = divmod(timestamp, SECONDS_PER_DAY)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return "{} {:02d}:{:02d}:{:02d}".format(_format_day(day), hours, minutes, seconds)
+
+
+class HikChannelIndex:
+    """
+    Rows of one channel sorted by start time.
+    A tree over the sorted rows holds the latest end time below every node, subtrees ending before the
+    query start are skipped. A single long block therefore does not make every query scan the channel.
+    """
+
+    def __init__(self, table, rows):
+        rows.sort(key=lambda row: (table.start_time[row], row))
+        self.rows = array('Q', rows)
+        self.start_time = array('I', (table.start_time[row] for row in rows))
+        self.end_time = array('I', (table.end_time[row] for row in rows))
+        # Complete binary tree in an array, the leaves from tree_size on are the sorted rows
+        self.tree_size = 1
+        while self.tree_size < len(rows):
+            self.tree_size *= 2
+        self.max_end_time = array('I', bytes(8 * self.tree_size))
+        self.max_end_time[self.tree_size:self.tree_size + len(rows)] = self.end_time
+        width = self.tree_size
+        while width > 1:
+            level = self.max_end_time[width:2 * width]
+            width //= 2
+            self.max_end_time[width:2 * width] = array('I', map(max, level[0::2], level[1::2]))
+
+    def query(self, start_time, end_time):
+        hi = len(self.rows) if end_time is None else bisect_right(self.start_time, end_time)
+        if start_time is None:
+            return self.rows[:hi].tolist()
+        rows = []
+        # Nodes as (node, first leaf, leaf count), the left child is visited first to keep the start time order
+        stack = [(1, 0, self.tree_size)]
+        while stack:
+            node, lo, width = stack.pop()
+            if lo >= hi or self.max_end_time[node] < start_time:
+                continue
+            if width == 1:
+                rows.append(self.rows[lo])
+                continue
+            width //= 2
+            stack.append((2 * node + 1, lo + width, width))
+            stack.append((2 * node, lo, width))
+        return rows
+
+
+class HikBlockIndex:
+    """
+    Channel and time range index over the block table.
+    query returns the k rows of all blocks overlapping the time range in O((k + 1) log n),
+    however long single blocks are.
+    """
+
+    def __init__(self, table):
+        self.size = len(table)
+        rows_by_channel = {}
+        for row, channel in enumerate(table.channel):
+            rows_by_channel.setdefault(channel, []).append(row)
+        self.channels = {channel: HikChannelIndex(table, rows) for channel, rows in rows_by_channel.items()}
+
+    def get_channels(self):
+        return sorted(self.channels)
+
+    def query(self, channels=None, start_time=None, end_time=None):
+        """
+        Rows of the blocks of the given channels (all if None) overlapping [start_time, end_time].
+        Open ends are given as None. Results are ordered by channel and start time.
+        """
+        if start_time is not None:
+            start_time = to_timestamp(start_time)
+        if end_time is not None:
+            end_time = to_timestamp(end_time)
+        if channels is None:
+            channels = self.get_channels()
+
+        rows = []
+        for channel in sorted(set(channels)):
+            channel_index = self.channels.get(channel)
+            if channel_index is not None:
+                rows.extend(channel_index.query(start_time, end_time))
+        return rows
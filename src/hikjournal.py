@@ -0,0 +1,76 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import os
+import logging
+import threading
+
+JOURNAL_NAME = "HIKJournal.log"
+
+
+class HikJournal:
+    """
+    Append-only journal of completed data blocks in the output directory.
+    Every line is "DONE;<file>;<size>;<algorithm>=<digest>,..." and is synced to disk before the next
+    block is reported, so a restarted extraction knows which files are complete.
+    """
+
+    def __init__(self, dir):
+        self.path = os.path.join(dir, JOURNAL_NAME)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+        self.file = open(self.path, "a", newline="")
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r", newline="") as file:
+            for line in file:
+                # A line without newline was torn by a crash and is ignored
+                if not line.endswith("\n"):
+                    break
+                fields = line.rstrip("\n").split(";")
+                if len(fields) != 4 or fields[0] != "DONE":
+                    continue
+                digests = dict(item.split("=", 1) for item in fields[3].split(",") if "=" in item)
+                self.entries[fields[1]] = (int(fields[2]), digests)
+        logging.info("Journal %s: %d completed blocks", self.path, len(self.entries))
+
+    def get_completed(self, fileName, hash_algorithms=()):
+        """
+        Returns (size, digests) if fileName was completed before, still has the recorded size
+        and the journal holds all requested digests, otherwise None.
+        """
+        entry = self.entries.get(os.path.basename(fileName))
+        if entry is None:
+            return None
+        size, digests = entry
+        if any(name not in digests for name in hash_algorithms):
+            return None
+        try:
+            if os.path.getsize(fileName) != size:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def record(self, fileName, size, digests):
+        name = os.path.basename(fileName)
+        line = "DONE;{};{};{}\n".format(name, size, ",".join("{}={}".format(*item) for item in digests.items()))
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries[name] = (size, digests)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,132 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+class HikMetrics:
+    """
+    Wall time per phase and I/O counters of one run.
+    Observers are called as observer(event, data) for "phase_start", "phase_end", "extract_start",
+    "block_extracted" and "block_skipped" events, data is a dict with the event details and the current counters.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.phases = {}
+        self.bytes_read = 0
+        self.read_calls = 0
+        self.seek_calls = 0
+        self.blocks_extracted = 0
+        self.blocks_skipped = 0
+        self.bytes_written = 0
+        self.hash_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.observers = []
+        self.lock = threading.Lock()
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def notify(self, event, **data):
+        if not self.observers:
+            return
+        data.update(self.get_counters())
+        for observer in list(self.observers):
+            try:
+                observer(event, data)
+            except Exception as e:
+                logging.error("Metrics observer failed: %s", e)
+
+    @contextmanager
+    def phase(self, name):
+        """ Measures the wall time of a phase, repeated phases are added up."""
+        self.notify("phase_start", phase=name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+            self.notify("phase_end", phase=name, seconds=seconds)
+
+    def count_read(self, num_bytes):
+        with self.lock:
+            self.read_calls += 1
+            self.bytes_read += num_bytes
+
+    def count_seek(self):
+        with self.lock:
+            self.seek_calls += 1
+
+    def count_cache(self, hit):
+        """ Lookup in the extent cache of HikCachedReader."""
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def count_hash_time(self, seconds):
+        with self.lock:
+            self.hash_seconds += seconds
+
+    def block_extracted(self, block, size):
+        with self.lock:
+            self.blocks_extracted += 1
+            self.bytes_written += size
+        self.notify("block_extracted", page=block.page_index + 1, block=block.block_index, size=size)
+
+    def block_skipped(self, block, size):
+        """ Block which was complete from an earlier run."""
+        with self.lock:
+            self.blocks_skipped += 1
+        self.notify("block_skipped", page=block.page_index + 1, block=block.block_index, size=size)
+
+    def get_counters(self):
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            "elapsed_seconds": elapsed,
+            "bytes_read": self.bytes_read,
+            "read_calls": self.read_calls,
+            "seek_calls": self.seek_calls,
+            "blocks_extracted": self.blocks_extracted,
+            "blocks_skipped": self.blocks_skipped,
+            "bytes_written": self.bytes_written,
+            "hash_seconds": self.hash_seconds,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+    def get_report(self):
+        report = self.get_counters()
+        report["phases"] = dict(self.phases)
+        extract_seconds = self.phases.get("extract")
+        if extract_seconds:
+            report["extract_mb_per_second"] = self.bytes_written / extract_seconds / (1024 * 1024)
+            report["extract_blocks_per_second"] = self.blocks_extracted / extract_seconds
+        if self.cache_hits or self.cache_misses:
+            report["cache_hit_ratio"] = self.cache_hits / (self.cache_hits + self.cache_misses)
+        if report["elapsed_seconds"]:
+            report["read_mb_per_second"] = self.bytes_read / report["elapsed_seconds"] / (1024 * 1024)
+        return report
+
+    def write_report(self, path):
+        with open(path, "w") as file:
+            json.dump(self.get_report(), file, indent=2, sort_keys=True)
@@ -13,13 +13,36 @@ import datetime
 
 class HikPageEntry:
 
+    __slots__ = ('offset_to_page', 'channel', 'start_time', 'end_time', 'data_offset',
+                 'block_table', 'first_block', 'block_count', '_data_blocks', 'start_end_time')
+
     def __init__(self):
         self.offset_to_page = 0
         self.channel = 0
         self.start_time = 0
         self.end_time = 0
         self.data_offset = 0
-        self.data_blocks = []
+        self.block_table = None
+        self.first_block = 0
+        self.block_count = 0
+        self._data_blocks = []
+
+    @property
+    def data_blocks(self):
+        """ Data blocks of this page, as views on the block table once the page was parsed into one."""
+        if self.block_table is not None:
+            return self.block_table.get_entries(self.first_block, self.block_count)
+        return self._data_blocks
+
+    @data_blocks.setter
+    def data_blocks(self, data_blocks):
+        self.block_table = None
+        self._data_blocks = data_blocks
+
+    def set_block_range(self, block_table, first_block, block_count):
+        self.block_table = block_table
+        self.first_block = first_block
+        self.block_count = block_count
 
     def __str__(self):
         return ("Offset to page: {}".format(self.offset_to_page) + "\n" +
@@ -63,4 +86,4 @@ class HikPageEntry:
         return self.data_offset
 
     def append_data_block(self, data_block):
-        self.data_blocks.append(data_block)
\ No newline at end of file
+        self._data_blocks.append(data_block)
\ No newline at end of file
@@ -15,14 +15,43 @@ from .hikpageentry import HikPageEntry
 from .hikbtree import HikBTree
 from .hikmastersector import HikMasterSector
 from .hikdatablockentry import HikDataBlockEntry
+from .hikblocktable import HikBlockTable
+from .hikreader import open_reader, HikMeteredReader, HikCachedReader, CACHE_EXTENT_SIZE, CACHE_BYTES
+from .hikmetrics import HikMetrics
+from .hikextractor import HikExtractor
+from .hikjournal import HikJournal, JOURNAL_NAME
+from .hikstitcher import HikStitcher
+from .hikindex import HikBlockIndex, format_time
+from .hikstream import find_stream_end
+from . import hikcache
+from . import hikcatalog
 from bitstring import ConstBitStream
+import os
 import struct
 import datetime
 import logging
 
 
 import datetime
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# On-disk layouts, all little endian
+MASTER_SECTOR_OFFSET = 528
+MASTER_SECTOR = struct.Struct('<32s24xQ16xQQ8xQ8xQI4xQI4xQI60xI')
+HIKBTREE_HEADER = struct.Struct('<16x8s36xIQ8xQQ')
+PAGE_LIST_HEADER = struct.Struct('<24xQ64xQ')
+PAGE_LIST_ENTRY = struct.Struct('<H6xIIQQ')
+PAGE_HEADER_SIZE = 96
+DATA_BLOCK_ENTRY = struct.Struct('<QQH6xIIQ')
+UNUSED_ENTRY = 0xFFFFFFFFFFFFFFFF
+
+# Records decoded per read when walking page entries
+RECORD_BATCH = 128
+REGION_READ_SIZE = 16 * 1024 * 1024
+SNAPSHOT_NAME = "HIKSnapshot.bin"
+SEEN_NAME = "HIKSnapshotSeen.bin"
+# Lines formatted before a write to the CSV tables
+CSV_BATCH = 4096
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
@@ -52,83 +81,189 @@ class HikParser(Exception):
         # self.data.pos += self.to_bit(offset)
         self.file_obj.seek(offset, 1)
 
-    def __init__(self, filename):
+    def __init__(self, filename, backend="file", metrics=None, cache_extent=CACHE_EXTENT_SIZE, cache_bytes=CACHE_BYTES):
         self.disk_name = filename
+        self.metrics = metrics if metrics is not None else HikMetrics()
         try:
-            self.file_obj = open(self.disk_name, 'rb')  # Sử dụng biến khác cho file object
+            # Sử dụng biến khác cho file object
+            self.file_obj = HikMeteredReader(open_reader(self.disk_name, backend), self.metrics)
+            # Small reads are served from aligned extents, a mapped image is in memory anyway
+            if cache_bytes and not self.file_obj.zero_copy:
+                self.file_obj = HikCachedReader(self.file_obj, cache_extent, cache_bytes, self.metrics)
         except Exception as e:
             logging.error(f"Error opening physical drive {self.disk_name}: {e}")
             raise
         self.master_sector = HikMasterSector()
         self.hikbtree = HikBTree()
         self.hikbtree.page_list = []
-
+        self.block_table = HikBlockTable()
+        self.block_index = None
+        self.hikbtree_region = None
+        self.hikbtree_region_offset = 0
 
     def __str__(self):
         return str(self.master_sector) + "\n" + str(self.hikbtree) + "\n" + str(self.hikpagelist)
 
     def get_total_blocks(self):
-        total = 0
-        for page in self.hikbtree.get_page_list():
-            total += len(page.data_blocks)
-
-        return total
+        return len(self.block_table)
+
+    def get_payload_sizes(self, rows=None):
+        """ Maps the data offset of every block (in rows, all if None) to the length of its valid stream."""
+        if rows is None:
+            rows = range(len(self.block_table))
+        offsets = self.block_table.data_offset
+        return {offsets[row]: find_stream_end(self.file_obj, offsets[row], self.master_sector.data_block_size)
+                for row in rows}
+
+    def get_pending_rows(self, dir, rows=None, hash_algorithms=("md5",)):
+        """ Block table rows (in rows, all if None) which the journal in dir does not list as extracted."""
+        if rows is None:
+            rows = range(len(self.block_table))
+        if not os.path.isfile(os.path.join(dir, JOURNAL_NAME)):
+            return rows
+        journal = HikJournal(dir)
+        try:
+            table = self.block_table
+            return [row for row in rows if journal.get_completed(
+                os.path.join(dir, self.block_file_name(table.get_entry(row))) + ".mp4", hash_algorithms) is None]
+        finally:
+            journal.close()
+
+    def query_blocks(self, channels=None, start_time=None, end_time=None):
+        """ Block table rows of the given channels overlapping the time range, see HikBlockIndex.query."""
+        if self.block_index is None or self.block_index.size != len(self.block_table):
+            self.block_index = HikBlockIndex(self.block_table)
+        return self.block_index.query(channels, start_time, end_time)
+
+    def block_file_name(self, block):
+        """ Output file name (without extension) of a data block entry."""
+        return datetime.datetime.utcfromtimestamp(block.start_time).strftime('%Y-%m-%d_%H-%M-%S') + "-" + \
+            datetime.datetime.utcfromtimestamp(block.end_time).strftime('%Y-%m-%d_%H-%M-%S') + \
+            "_ch_" + str(block.channel) + "_id_" + str(block.block_index)
 
     def hex_to_string(self, hex):
         return bytes.fromhex(str(hex)[2:])
 
     def hex_to_ascii(self, hex):
-        return bytes.fromhex(str(hex)[2:]).decode("ASCII").strip(' \t\n\r')
+        return bytes(hex).decode("ASCII", errors="replace").strip(' \t\n\r\x00')
 
     def read_master_sector(self):
-        self.file_obj.read(528)
-        # self.set_pos(528)
-        signature_data = self.read_bytes(32)
+        """
+        Reads master sector of HIKVISION systems and write its content into class.
+        Initial position should always be Offset 528 Byte.
+        """
+        (signature_data, hdd_cap, sys_log_offset, sys_log_size, video_data_area_offset,
+         data_block_size, data_block_total, hikbtree1_offset, hikbtree1_size,
+         hikbtree2_offset, hikbtree2_size, init_time) = self._unpack_at(MASTER_SECTOR, MASTER_SECTOR_OFFSET)
+
         self.master_sector.signatur = self.hex_to_ascii(signature_data)
         logging.info(f"signature_data {self.master_sector.signatur}")
         if not self.master_sector.check_signatur():
             raise Exception('SignatureException: Signature not equal to HIKVISION@HANGZHOU!')
-        self.skip_bytes(24)
-        hdd_cap_data = self.read_bytes(8)
-        self.master_sector.hdd_cap = struct.unpack('<Q', hdd_cap_data)[0]  # Sử dụng 'Q' cho unsigned long long (uint64)
-
-        self.skip_bytes(16)
-        sys_log_offset_data = self.read_bytes(8)
-        self.master_sector.sys_log_offset = struct.unpack('<Q', sys_log_offset_data)[0]
 
-        sys_log_size_data = self.read_bytes(8)
-        self.master_sector.sys_log_size = struct.unpack('<Q', sys_log_size_data)[0]
-
-        self.skip_bytes(8)
-        video_data_area_offset_data = self.read_bytes(8)
-        self.master_sector.video_data_area_offset = struct.unpack('<Q', video_data_area_offset_data)[0]
-
-        self.skip_bytes(8)
-        data_block_size_data = self.read_bytes(8)
-        self.master_sector.data_block_size = struct.unpack('<Q', data_block_size_data)[0]
+        self.master_sector.hdd_cap = hdd_cap
+        self.master_sector.sys_log_offset = sys_log_offset
+        self.master_sector.sys_log_size = sys_log_size
+        self.master_sector.video_data_area_offset = video_data_area_offset
+        self.master_sector.data_block_size = data_block_size
+        self.master_sector.data_block_total = data_block_total
+        self.master_sector.hikbtree1_offset = hikbtree1_offset
+        self.master_sector.hikbtree1_size = hikbtree1_size
+        self.master_sector.hikbtree2_offset = hikbtree2_offset
+        self.master_sector.hikbtree2_size = hikbtree2_size
+        self.master_sector.init_time = datetime.datetime.fromtimestamp(init_time).strftime('%d.%m.%Y %H:%M:%S')
+        logging.info("End read master")
 
-        data_block_total_data = self.read_bytes(4)
-        self.master_sector.data_block_total = struct.unpack('<I', data_block_total_data)[0]  # Sử dụng 'I' cho unsigned int (uint32)
+    def load_hikbtree_region(self):
+        """
+        Reads the whole HIKBTree 1 region in one sequential pass.
+        Afterwards the B-tree header, page list and page entries located inside the
+        region are decoded from memory instead of single reads on the disk.
+        """
+        offset = self.master_sector.hikbtree1_offset
+        size = self.master_sector.hikbtree1_size
+        self.hikbtree_region = None
+        if self.file_obj.zero_copy:
+            region = self.file_obj.read_at(offset, size)
+            filled = len(region)
+        else:
+            self.set_pos(offset)
+            region = bytearray(size)
+            view = memoryview(region)
+            filled = 0
+            while filled < size:
+                data = self.read_bytes(min(REGION_READ_SIZE, size - filled))
+                if not data:
+                    break
+                view[filled:filled + len(data)] = data
+                filled += len(data)
+        self.hikbtree_region_offset = offset
+        self.hikbtree_region = memoryview(region)[:filled]
+        logging.info("HIKBTree region loaded: %d bytes at offset %d", filled, offset)
 
-        self.skip_bytes(4)
-        hikbtree1_offset_data = self.read_bytes(8)
-        self.master_sector.hikbtree1_offset = struct.unpack('<Q', hikbtree1_offset_data)[0]
+    def load_metadata_cache(self, cache_dir):
+        """
+        Restores HIKBTree, page list and data block entries from the cache in cache_dir.
+        Needs the master sector, returns False if the cache is missing or belongs to another image state.
+        """
+        return hikcache.load_metadata(self, hikcache.cache_file_name(cache_dir, self.disk_name))
 
-        hikbtree1_size_data = self.read_bytes(4)
-        self.master_sector.hikbtree1_size = struct.unpack('<I', hikbtree1_size_data)[0]
+    def save_metadata_cache(self, cache_dir):
+        hikcache.save_metadata(self, hikcache.cache_file_name(cache_dir, self.disk_name))
 
-        self.skip_bytes(4)
-        hikbtree2_offset_data = self.read_bytes(8)
-        self.master_sector.hikbtree2_offset = struct.unpack('<Q', hikbtree2_offset_data)[0]
+    def load_snapshot(self, dir):
+        """ Snapshot of the last incremental run in dir with the blocks extracted so far, None if there is none."""
+        snapshot = hikcache.load_snapshot(os.path.join(dir, SNAPSHOT_NAME))
+        if snapshot is not None:
+            snapshot.seen = hikcache.load_seen_blocks(os.path.join(dir, SEEN_NAME))
+        return snapshot
 
-        hikbtree2_size_data = self.read_bytes(4)
-        self.master_sector.hikbtree2_size = struct.unpack('<I', hikbtree2_size_data)[0]
+    def save_snapshot(self, dir, extracted_rows=None, snapshot=None):
+        """
+        Stores the metadata for the next incremental run. Only the blocks in extracted_rows (all if None)
+        and those the snapshot of the last run has seen count as extracted, all others stay new.
+        """
+        table = self.block_table
+        hikcache.save_metadata(self, os.path.join(dir, SNAPSHOT_NAME))
+        extracted = set(range(len(table)) if extracted_rows is None else extracted_rows)
+        if snapshot is not None:
+            extracted.update(row for row in range(len(table)) if snapshot.contains_block(table, row))
+        hikcache.save_seen_blocks(os.path.join(dir, SEEN_NAME), (hikcache.block_key(table, row) for row in extracted))
+
+    def get_changed_blocks(self, snapshot, rows=None):
+        """ Rows (of all or the given rows) whose block is not contained in the snapshot."""
+        if rows is None:
+            rows = range(len(self.block_table))
+        if snapshot is None:
+            return list(rows)
+        return [row for row in rows if not snapshot.contains_block(self.block_table, row)]
+
+    def _read_at(self, offset, size):
+        """ Returns size bytes at offset, from the HIKBTree region if it covers them."""
+        region = self.hikbtree_region
+        if region is not None:
+            start = offset - self.hikbtree_region_offset
+            if 0 <= start and start + size <= len(region):
+                return region[start:start + size]
+        return self.file_obj.read_at(offset, size)
+
+    def _unpack_at(self, layout, offset):
+        data = self._read_at(offset, layout.size)
+        if len(data) < layout.size:
+            raise Exception('ReadException: Unexpected end of data at offset {}'.format(offset))
+        return layout.unpack(data)
+
+    def _iter_records(self, layout, offset):
+        """ Yields consecutive records of the given layout starting at offset."""
+        window = layout.size * RECORD_BATCH
+        while True:
+            data = self._read_at(offset, window)
+            usable = len(data) - len(data) % layout.size
+            if not usable:
+                return
+            yield from layout.iter_unpack(data[:usable])
+            offset += usable
 
-        self.skip_bytes(60)
-        init_time_data = self.read_bytes(4)
-        init_time = struct.unpack('<I', init_time_data)[0]
-        self.master_sector.init_time = datetime.datetime.fromtimestamp(init_time).strftime('%d.%m.%Y %H:%M:%S'),
-        logging.info("End read master")
     # def read_master_sector(self):
     #     """
     #        Reads master sector of HIKVISION systems and write its content into class.
@@ -166,30 +301,14 @@ class HikParser(Exception):
         Reads the first of the two HIKBTrees and writes to class.
         Initial offset for HIKBTree is located in master sector.
         """
-        self.set_pos(self.master_sector.hikbtree1_offset)
-
-        # Skip 16 unused bytes
-        self.skip_bytes(16)
+        (signature_data, created_time, footer_offset,
+         page_list_offset, page_one_offset) = self._unpack_at(HIKBTREE_HEADER, self.master_sector.hikbtree1_offset)
 
-        signature_data = self.read_bytes(8)
         self.hikbtree.signatur = self.hex_to_ascii(signature_data)
-
-        self.skip_bytes(36)
-
-        created_time_data = self.read_bytes(4)
-        created_time = struct.unpack('<I', created_time_data)[0]
-        self.hikbtree.created_time = datetime.datetime.fromtimestamp(created_time).strftime('%d.%m.%Y %H:%M:%S'),
-
-        footer_offset_data = self.read_bytes(8)
-        self.hikbtree.footer_offset = struct.unpack('<Q', footer_offset_data)[0]
-
-        self.skip_bytes(8)
-
-        page_list_offset_data = self.read_bytes(8)
-        self.hikbtree.page_list_offset = struct.unpack('<Q', page_list_offset_data)[0]
-
-        page_one_offset_data = self.read_bytes(8)
-        self.hikbtree.page_one_offset = struct.unpack('<Q', page_one_offset_data)[0]
+        self.hikbtree.created_time = datetime.datetime.fromtimestamp(created_time).strftime('%d.%m.%Y %H:%M:%S')
+        self.hikbtree.footer_offset = footer_offset
+        self.hikbtree.page_list_offset = page_list_offset
+        self.hikbtree.page_one_offset = page_one_offset
     # def read_hikbtree(self):
     #     """
     #         Reads the first of the two HISBTREES and writes to class.
@@ -210,49 +329,65 @@ class HikParser(Exception):
 
     def read_page_list(self):
         """ Reads page list page for page and writes content into list."""
-        
-        self.set_pos(self.hikbtree.page_list_offset)
-        self.skip_bytes(24)
-        first_page_offset_data = self.read_bytes(8)
-        first_page_offset = struct.unpack('<Q', first_page_offset_data)[0]
-        
-        self.skip_bytes(64)  # Đã bao gồm 64 bytes cần bỏ qua thay vì bỏ qua 96 bytes tổng cộng
-        
-        page_offset_data = self.read_bytes(8)
-        page_offset = struct.unpack('<Q', page_offset_data)[0]
-        
-        # Add first page to entries
+        for page in self._walk_page_list():
+            self.hikbtree.add_hikpage(page)
+
+    def _walk_page_list(self):
+        first_page_offset, page_offset = self._unpack_at(PAGE_LIST_HEADER, self.hikbtree.page_list_offset)
+
+        # The first page is not listed in the page list, we have to put it in manually
         page = HikPageEntry()
         page.offset_to_page = first_page_offset
-        page.data_blocks = []
-        self.hikbtree.add_hikpage(page)
-        
+        yield page
+
         while page_offset != 0:
-            self.set_pos(page_offset)
-            
             page = HikPageEntry()
             page.offset_to_page = page_offset
-            
-            channel_data = self.read_bytes(2)
-            page.channel = struct.unpack('<H', channel_data)[0]  # Giả định là unsigned short (2 bytes)
-            
-            self.skip_bytes(6)  # Điều chỉnh tùy thuộc vào cấu trúc dữ liệu
-            
-            start_time_data = self.read_bytes(4)
-            page.start_time = struct.unpack('<I', start_time_data)[0]  # unsigned int
-            
-            end_time_data = self.read_bytes(4)
-            page.end_time = struct.unpack('<I', end_time_data)[0]  # unsigned int
-            
-            data_offset_data = self.read_bytes(8)
-            page.data_offset = struct.unpack('<Q', data_offset_data)[0]
-            
-            page.data_blocks = []
-            self.hikbtree.add_hikpage(page)
-            
-            # Đọc offset của trang tiếp theo
-            page_offset_data = self.read_bytes(8)
-            page_offset = struct.unpack('<Q', page_offset_data)[0]
+            (page.channel, page.start_time, page.end_time,
+             page.data_offset, page_offset) = self._unpack_at(PAGE_LIST_ENTRY, page_offset)
+            yield page
+
+    def iter_pages(self):
+        """ Yields the pages, decoded one by one from the image if the page list was not read before."""
+        if self.hikbtree.get_page_list():
+            yield from self.hikbtree.get_page_list()
+        else:
+            yield from self._walk_page_list()
+
+    def iter_blocks(self, filter=None):
+        """
+        Yields the data block entries, for which filter(entry) is true if a filter is given.
+        If the page entries were not read before, every page is decoded only when its blocks are due,
+        so memory stays constant and consumers start before the whole tree is parsed.
+        """
+        if len(self.block_table):
+            blocks = (self.block_table.get_entry(row) for row in range(len(self.block_table)))
+        else:
+            blocks = self._walk_blocks()
+        for block in blocks:
+            if filter is None or filter(block):
+                yield block
+
+    def iter_block_rows(self, rows=None):
+        """
+        Yields (page_index, block_index, channel, start_time, end_time, data_offset) per data block,
+        from the block table or, if the page entries were not read, decoded while walking the tree.
+        """
+        if len(self.block_table) or rows is not None:
+            return self.block_table.iter_rows(rows)
+        return ((block.page_index, block.block_index, block.channel, block.start_time, block.end_time,
+                 block.data_offset) for block in self._walk_blocks())
+
+    def _walk_blocks(self):
+        for page_index, page in enumerate(self.iter_pages()):
+            for block_index, record in enumerate(self._read_page_records(page), 1):
+                data_block = HikDataBlockEntry()
+                (_, data_block.existence_of_file, data_block.channel, data_block.start_time,
+                 data_block.end_time, data_block.data_offset) = record
+                data_block.page_index = page_index
+                data_block.block_index = block_index
+                yield data_block
+
     # def read_page_list(self):
     #     """ Reads page list page for page and writes content into list."""
 
@@ -285,47 +420,50 @@ class HikParser(Exception):
     #         self.skip_bytes(8)
     #         page_offset = self.data.read('uintle:64')
 
-    def read_page_entries(self):
-        for page in self.hikbtree.get_page_list():
-            self.set_pos(page.offset_to_page + 96)  # Bỏ qua 96 bytes đầu tiên của mỗi trang
-
-            while True:
-                # Đọc 8 bytes tiếp theo và kiểm tra xem chúng có phải là bytes không sử dụng hay không
-                unused_bytes_data = self.read_bytes(8)
-                unused_bytes = struct.unpack('<Q', unused_bytes_data)[0]
-                
-                if unused_bytes == 0xFFFFFFFFFFFFFFFF:  # Kết thúc các mục dữ liệu nếu gặp bytes không sử dụng
-                    break
-
-                # Đọc thông tin về mỗi data block
-                existence_of_file_data = self.read_bytes(8)
-                existence_of_file = struct.unpack('<Q', existence_of_file_data)[0]
-                
-                channel_data = self.read_bytes(2)
-                channel = struct.unpack('<H', channel_data)[0]  # Giả sử channel là unsigned short (2 bytes)
-
-                self.skip_bytes(6)  # Bỏ qua bytes không cần thiết giữa các trường
-
-                start_time_data = self.read_bytes(4)
-                start_time = struct.unpack('<I', start_time_data)[0]  # unsigned int
-                
-                end_time_data = self.read_bytes(4)
-                end_time = struct.unpack('<I', end_time_data)[0]  # unsigned int
-                
-                data_offset_data = self.read_bytes(8)
-                data_offset = struct.unpack('<Q', data_offset_data)[0]  # unsigned long long
-
-                # Thêm data block vào trang
-                data_block = HikDataBlockEntry()
-                data_block.existence_of_file = existence_of_file
-                data_block.channel = channel
-                data_block.start_time = start_time
-                data_block.end_time = end_time
-                data_block.data_offset = data_offset
-                page.data_blocks.append(data_block)
-
-                # Đọc 8 bytes tiếp theo để chuẩn bị cho lần lặp tiếp theo
-                # Lưu ý: Nếu có bất kỳ dữ liệu padding hoặc bổ sung nào giữa các data block, bạn cần skip chính xác số byte đó
+    def read_page_entries(self, workers=1, snapshot=None):
+        """
+        Reads the data block entries of all pages into the block table.
+        With workers > 1 the pages are parsed concurrently with positional reads,
+        results are merged in page order.
+        Pages whose page list values equal those in snapshot are taken from it without parsing.
+        """
+        self.block_table.clear()
+        pages = self.hikbtree.get_page_list()
+        reparsed = 0
+
+        def page_records(page_index, page):
+            # The first page has no page list entry, so it can not be compared and is always parsed
+            if snapshot is not None and page_index > 0:
+                records = snapshot.get_page_records(page)
+                if records is not None:
+                    return records, False
+            return self._read_page_records(page), True
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(page_records, range(len(pages)), pages)
+                for page_index, (page, (records, parsed)) in enumerate(zip(pages, results)):
+                    first_block = self.block_table.append_page(page_index, records)
+                    page.set_block_range(self.block_table, first_block, len(records))
+                    reparsed += parsed
+        else:
+            for page_index, page in enumerate(pages):
+                records, parsed = page_records(page_index, page)
+                first_block = self.block_table.append_page(page_index, records)
+                page.set_block_range(self.block_table, first_block, len(records))
+                reparsed += parsed
+
+        if snapshot is not None:
+            logging.info("%d of %d pages parsed, the rest taken from the snapshot", reparsed, len(pages))
+
+    def _read_page_records(self, page):
+        # Skip the 96 byte page header, entries follow until an unused entry is found
+        records = []
+        for record in self._iter_records(DATA_BLOCK_ENTRY, page.offset_to_page + PAGE_HEADER_SIZE):
+            if record[0] == UNUSED_ENTRY:
+                break
+            records.append(record)
+        return records
     # def read_page_entries(self):
     #     for page in self.hikbtree.get_page_list():
     #         self.set_pos(page.offset_to_page)
@@ -344,58 +482,58 @@ class HikParser(Exception):
     #             self.skip_bytes(8)
     #             unused_bytes = self.data.read('uintle:64')
 
-    def extract_block(self, dir):
-        i = 1
-        for page in self.hikbtree.get_page_list():
-            j = 1
-            for datablock in page.data_blocks:
-                length = self.master_sector.data_block_size
-                with open(self.file_obj, 'rb') as f1:
-                    f1.seek(datablock.data_offset)
-                    fileName = dir + "\\" + datetime.datetime.utcfromtimestamp(datablock.start_time).strftime(
-                        '%Y-%m-%d_%H-%M-%S') + "-" + \
-                               datetime.datetime.utcfromtimestamp(datablock.end_time).strftime('%Y-%m-%d_%H-%M-%S') + \
-                               "_ch_" + str(int.from_bytes(self.hex_to_string(datablock.channel), byteorder="big")) + \
-                               "_id_" + str(j)
-
-                    fileNameMD5 = fileName + ".md5"
-                    fileName = fileName + ".mp4"
-
-                    md5Hash = hashlib.md5()
-                    with open(fileName, 'wb') as f2:
-                        while length:
-                            chunk = min(1024 * 1024, length)
-                            data = f1.read(chunk)
-                            f2.write(data)
-                            length -= chunk
-                            md5Hash.update(data)
-                        print("Block {} of page {} extracted!".format(j, i))
-                    with open (fileNameMD5, 'w') as f3:
-                        f3.write(md5Hash.hexdigest())
-                    f2.close()
-                    f3.close()
-                    j += 1
-                f1.close()
-            i += 1
+    def extract_block(self, dir, workers=1, max_buffers=None, order="offset", method="read",
+                      hash_algorithms=("md5",), rows=None, resume=True, streaming=False, trim=None,
+                      payload_sizes=None, cancel_event=None, stitch=None, blocks=None, reserve_space=None,
+                      max_run_blocks=None, append_manifest=False):
+        """
+        Extracts the data blocks in rows (all if None) into dir, see HikExtractor for the settings.
+        With streaming the blocks are taken from blocks, iter_blocks if None, in page order while the pages
+        are parsed.
+        stitch "channel" or "day" writes one file per channel or per channel and day, see HikStitcher.
+        trim None trims stitched blocks only, the stale tail of a full block would land in the middle
+        of the stitched file.
+        max_run_blocks limits the sequential runs, None splits them into one share per worker.
+        append_manifest adds the rows to the manifest of an earlier run, see HikExtractor.
+        """
+        if trim is None:
+            trim = stitch is not None
+        if stitch is not None:
+            if stitch not in ("channel", "day"):
+                raise ValueError("Unknown stitch mode: {}".format(stitch))
+            if streaming:
+                raise ValueError("Stitching orders the blocks by time and needs the whole block table")
+            stitcher = HikStitcher(self, workers, max_buffers, hash_algorithms=hash_algorithms, resume=resume,
+                                   trim=trim, payload_sizes=payload_sizes, cancel_event=cancel_event,
+                                   per_day=stitch == "day", reserve_space=reserve_space)
+            return stitcher.extract(dir, rows)
+        extractor = HikExtractor(self, workers, max_buffers, max_run_blocks=max_run_blocks, method=method,
+                                 hash_algorithms=hash_algorithms, resume=resume, trim=trim,
+                                 payload_sizes=payload_sizes, cancel_event=cancel_event, reserve_space=reserve_space,
+                                 append_manifest=append_manifest)
+        if streaming:
+            return extractor.extract_stream(dir, self.iter_blocks() if blocks is None else blocks)
+        return extractor.extract(dir, rows, order=order)
 
     def print_hikpagelist(self, dir):
-        with open(dir + "\\HIKPageList.csv", "w", newline="") as file:
-            i = 1
+        with open(os.path.join(dir, "HIKPageList.csv"), "w", newline="") as file:
             file.write("Page;Channel;Starttime;Endtime;Offset\n")
-            for page in self.hikbtree.get_page_list():
-                output = "{};{};{};{};{}".format(
-                    str(i),
-                    int.from_bytes(self.hex_to_string(page.channel), byteorder="big"),
-                    datetime.datetime.utcfromtimestamp(page.start_time).strftime('%d.%m.%Y %H:%M:%S'),
-                    datetime.datetime.utcfromtimestamp(page.end_time).strftime('%d.%m.%Y %H:%M:%S'),
+            lines = []
+            for i, page in enumerate(self.iter_pages(), 1):
+                lines.append("{};{};{};{};{}\n".format(
+                    i,
+                    page.channel,
+                    format_time(page.start_time),
+                    format_time(page.end_time),
                     page.offset_to_page
-                )
-                file.write(output + "\n")
-                i += 1
-        file.close()
+                ))
+                if len(lines) >= CSV_BATCH:
+                    file.writelines(lines)
+                    lines.clear()
+            file.writelines(lines)
 
     def print_hikbtree(self, dir):
-        with open(dir + "\\HIKBTree.txt", "w", newline="") as file:
+        with open(os.path.join(dir, "HIKBTree.txt"), "w", newline="") as file:
             file.write("Signature: {}\n".format(self.hikbtree.signatur))
             file.write("Creation date: {}\n".format(self.hikbtree.created_time))
             file.write("Offset to footer: {}\n".format(self.hikbtree.footer_offset))
@@ -403,29 +541,20 @@ class HikParser(Exception):
             file.write("Offset to first page: {}\n".format(self.hikbtree.page_one_offset))
         file.close()
 
-    def print_hikpages(self, dir):
-        with open(dir + "\\HIKPages.csv", "w", newline="") as file:
-            i = 1
-            file.write("Page;Datablock;Channel;Starttime;Endtime;Offset\n")
-            for page_entry in self.hikbtree.get_page_list():
-                j = 1
-                for page in page_entry.data_blocks:
-                    output = "{};{};{};{};{};{}".format(
-                        str(i),
-                        str(j),
-                        int.from_bytes(self.hex_to_string(page.channel), byteorder="big"),
-                        datetime.datetime.utcfromtimestamp(page.start_time).strftime('%d.%m.%Y %H:%M:%S'),
-                        datetime.datetime.utcfromtimestamp(page.end_time).strftime('%d.%m.%Y %H:%M:%S'),
-                        page.data_offset
-                    )
-                    file.write(output + "\n")
-                    j += 1
-                j = 0
-                i += 1
-        file.close()
+    def print_hikpages(self, dir, rows=None):
+        writer = HikPagesWriter(dir)
+        try:
+            for row in self.iter_block_rows(rows):
+                writer.add_row(*row)
+        finally:
+            writer.close()
+
+    def write_catalog(self, dir, rows=None):
+        """ Writes master sector, HIKBTree, pages and data blocks (in rows, all if None) into an SQLite catalog."""
+        return hikcatalog.write_catalog(self, os.path.join(dir, hikcatalog.CATALOG_NAME), rows)
 
     def print_master_sector(self, dir):
-        with open(dir + "\\HIKMasterSector.txt", "w", newline="") as file:
+        with open(os.path.join(dir, "HIKMasterSector.txt"), "w", newline="") as file:
             file.write("Signature: {}\n".format(self.master_sector.signatur))
             file.write("Hard disk size: {}\n".format(self.master_sector.hdd_cap))
             file.write("Offset to system logs: {}\n".format(self.master_sector.sys_log_offset))
@@ -441,6 +570,29 @@ class HikParser(Exception):
         file.close()
 
 
-
-
-
+class HikPagesWriter:
+    """ Writes HIKPages.csv row by row, so the table can be filled while the blocks are streamed."""
+
+    def __init__(self, dir):
+        self.file = open(os.path.join(dir, "HIKPages.csv"), "w", newline="")
+        self.file.write("Page;Datablock;Channel;Starttime;Endtime;Offset\n")
+        self.lines = []
+
+    def add_row(self, page_index, block_index, channel, start_time, end_time, data_offset):
+        self.lines.append("{};{};{};{};{};{}\n".format(
+            page_index + 1,
+            block_index,
+            channel,
+            format_time(start_time),
+            format_time(end_time),
+            data_offset
+        ))
+        if len(self.lines) >= CSV_BATCH:
+            self.file.writelines(self.lines)
+            self.lines.clear()
+
+    def close(self, complete=True):
+        """ Writes the pending rows, an incomplete table keeps the rows added so far."""
+        self.file.writelines(self.lines)
+        self.lines.clear()
+        self.file.close()
@@ -0,0 +1,501 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import io
+import os
+import mmap
+import logging
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Reads of at least this size are bulk copies of the data area, smaller ones are metadata
+BULK_READ_SIZE = 256 * 1024
+# Alignment of offsets, lengths and buffers for O_DIRECT, covers devices with 512 byte and 4K sectors
+DIRECT_ALIGNMENT = 4096
+# Aligned extents read by HikCachedReader and the byte budget of its cache
+CACHE_EXTENT_SIZE = 128 * 1024
+CACHE_BYTES = 32 * 1024 * 1024
+# Open segment files kept by HikSegmentReader
+SEGMENT_HANDLES = 16
+
+
+def _pread(fd, num_bytes, offset):
+    """ Positional read which collects short reads (e.g. on devices) until num_bytes or the end of the file."""
+    data = os.pread(fd, num_bytes, offset)
+    if len(data) == num_bytes or not data:
+        return data
+    parts = [data]
+    read = len(data)
+    while read < num_bytes:
+        data = os.pread(fd, num_bytes - read, offset + read)
+        if not data:
+            break
+        parts.append(data)
+        read += len(data)
+    return b"".join(parts)
+
+
+def find_segments(filename):
+    """
+    Segments of a split image (image.001, image.002, ...) in order, starting with .000 or .001,
+    for any of its segment names. Returns [filename] if the image is not split.
+    """
+    base, ext = os.path.splitext(filename)
+    digits = ext[1:]
+    if len(digits) < 3 or not digits.isdigit():
+        return [filename]
+    number = 0 if os.path.isfile("{}.{:0{}d}".format(base, 0, len(digits))) else 1
+    segments = []
+    while True:
+        name = "{}.{:0{}d}".format(base, number, len(digits))
+        if not os.path.isfile(name):
+            break
+        segments.append(name)
+        number += 1
+    if filename not in segments:
+        return [filename]
+    return segments
+
+
+class HikReader:
+    """
+    Common interface of all image readers.
+    Readers behave like a read-only binary file and additionally support positional reads.
+    """
+
+    # True if read/read_at return views on the image instead of copies
+    zero_copy = False
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        raise NotImplementedError
+
+    def tell(self):
+        raise NotImplementedError
+
+    def read(self, num_bytes):
+        raise NotImplementedError
+
+    def read_at(self, offset, num_bytes):
+        raise NotImplementedError
+
+    def get_size(self):
+        raise NotImplementedError
+
+    def fileno(self):
+        raise io.UnsupportedOperation("fileno")
+
+    def close(self):
+        pass
+
+
+class HikPositionalReader(HikReader):
+    """ Reader built on positional reads, seek/tell/read keep their own position and use read_at."""
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.pos = 0
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.get_size()
+        self.pos = pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, num_bytes):
+        data = self.read_at(self.pos, num_bytes)
+        self.pos += len(data)
+        return data
+
+
+class HikFileReader(HikReader):
+    """
+    Reads the image through a buffered file object. Works for image files and raw devices.
+    With advise the kernel is told that the image is read sequentially, and bulk reads are dropped
+    from the page cache afterwards, so a long extraction does not evict the cache of other processes.
+    """
+
+    def __init__(self, filename, advise=True):
+        super().__init__(filename)
+        self.file_obj = open(filename, 'rb')
+        self.lock = threading.Lock()
+        self.advise = advise and hasattr(os, 'posix_fadvise')
+        if self.advise:
+            try:
+                os.posix_fadvise(self.file_obj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                self.advise = False
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        return self.file_obj.seek(pos, whence)
+
+    def tell(self):
+        return self.file_obj.tell()
+
+    def read(self, num_bytes):
+        return self.file_obj.read(num_bytes)
+
+    def read_at(self, offset, num_bytes):
+        """ Positional read, does not touch the file position and is safe to call from several threads."""
+        data = self._read_at(offset, num_bytes)
+        if self.advise and len(data) >= BULK_READ_SIZE:
+            os.posix_fadvise(self.file_obj.fileno(), offset, len(data), os.POSIX_FADV_DONTNEED)
+        return data
+
+    def _read_at(self, offset, num_bytes):
+        if hasattr(os, 'pread'):
+            return _pread(self.file_obj.fileno(), num_bytes, offset)
+        with self.lock:
+            pos = self.file_obj.tell()
+            self.file_obj.seek(offset)
+            data = self.file_obj.read(num_bytes)
+            self.file_obj.seek(pos)
+            return data
+
+    def get_size(self):
+        pos = self.file_obj.tell()
+        size = self.file_obj.seek(0, io.SEEK_END)
+        self.file_obj.seek(pos)
+        return size
+
+    def fileno(self):
+        return self.file_obj.fileno()
+
+    def close(self):
+        self.file_obj.close()
+
+
+class HikDirectReader(HikPositionalReader):
+    """
+    Reads the image with O_DIRECT, bypassing the page cache completely.
+    Offsets, lengths and buffers are aligned to DIRECT_ALIGNMENT, every thread reads into its own
+    page aligned buffer. Small metadata reads are cached by the HikCachedReader above it.
+    """
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        if not hasattr(os, 'O_DIRECT'):
+            raise OSError("O_DIRECT is not supported on this platform")
+        self.fd = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        self.buffers = threading.local()
+
+    def read_at(self, offset, num_bytes):
+        return self._read_direct(offset, num_bytes)
+
+    def _get_buffer(self, length):
+        buffer = getattr(self.buffers, "buffer", None)
+        if buffer is None or len(buffer) < length:
+            if buffer is not None:
+                buffer.close()
+            # Anonymous mappings are page aligned
+            buffer = mmap.mmap(-1, max(length, BULK_READ_SIZE))
+            self.buffers.buffer = buffer
+        return buffer
+
+    def _read_direct(self, offset, num_bytes):
+        start = offset - offset % DIRECT_ALIGNMENT
+        end = offset + num_bytes
+        length = end - start + (-(end - start) % DIRECT_ALIGNMENT)
+        with memoryview(self._get_buffer(length)) as view:
+            read = 0
+            while read < length:
+                count = os.preadv(self.fd, [view[read:length]], start + read)
+                read += count
+                # A short read ends at the end of the image, the next offset would not be aligned anyway
+                if count == 0 or count % DIRECT_ALIGNMENT:
+                    break
+            return bytes(view[offset - start:max(offset - start, min(read, end - start))])
+
+    def get_size(self):
+        return self.size
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+
+class HikSegmentReader(HikPositionalReader):
+    """
+    Reads a split image (image.001, image.002, ...) as one concatenated image.
+    Global offsets are mapped to a segment by binary search over the segment start offsets,
+    reads crossing a segment boundary are joined. At most max_handles segment files are kept
+    open, the least recently used one is closed when another segment is needed.
+    """
+
+    def __init__(self, filenames, max_handles=SEGMENT_HANDLES):
+        super().__init__(filenames[0])
+        self.filenames = list(filenames)
+        self.starts = []
+        size = 0
+        for name in self.filenames:
+            self.starts.append(size)
+            size += os.path.getsize(name)
+        self.size = size
+        self.max_handles = max(1, max_handles)
+        # Segment index -> [file descriptor, number of reads using it]
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read_at(self, offset, num_bytes):
+        parts = []
+        end = min(offset + num_bytes, self.size)
+        while offset < end:
+            index = bisect_right(self.starts, offset) - 1
+            segment_end = self.starts[index + 1] if index + 1 < len(self.starts) else self.size
+            fd = self._acquire(index)
+            try:
+                data = _pread(fd, min(end, segment_end) - offset, offset - self.starts[index])
+            finally:
+                self._release(index)
+            if not data:
+                break
+            parts.append(data)
+            offset += len(data)
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+    def _acquire(self, index):
+        with self.lock:
+            handle = self.handles.get(index)
+            if handle is None:
+                handle = [os.open(self.filenames[index], os.O_RDONLY | getattr(os, 'O_BINARY', 0)), 1]
+                self.handles[index] = handle
+                self._evict()
+            else:
+                self.handles.move_to_end(index)
+                handle[1] += 1
+            return handle[0]
+
+    def _release(self, index):
+        with self.lock:
+            self.handles[index][1] -= 1
+            self._evict()
+
+    def _evict(self):
+        # Handles still in use by another thread are closed later, after their read
+        for index in list(self.handles):
+            if len(self.handles) <= self.max_handles:
+                break
+            fd, users = self.handles[index]
+            if not users:
+                os.close(fd)
+                del self.handles[index]
+
+    def get_size(self):
+        return self.size
+
+    def close(self):
+        with self.lock:
+            for fd, _ in self.handles.values():
+                os.close(fd)
+            self.handles.clear()
+
+
+class HikMmapReader(HikPositionalReader):
+    """ Maps the image into memory, reads return memoryview slices without copying."""
+
+    zero_copy = True
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.file_obj = open(filename, 'rb')
+        try:
+            self.mapping = mmap.mmap(self.file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.file_obj.close()
+            raise
+        self.data = memoryview(self.mapping)
+
+    def read_at(self, offset, num_bytes):
+        return self.data[offset:offset + num_bytes]
+
+    def get_size(self):
+        return len(self.data)
+
+    def fileno(self):
+        return self.file_obj.fileno()
+
+    def close(self):
+        self.data.release()
+        try:
+            self.mapping.close()
+        except BufferError:
+            # Slices handed out are still alive, the mapping is freed with them
+            pass
+        self.file_obj.close()
+
+
+class HikMeteredReader(HikReader):
+    """ Passes all calls to another reader and counts reads, read bytes and seeks in a HikMetrics object."""
+
+    def __init__(self, reader, metrics):
+        super().__init__(reader.filename)
+        self.reader = reader
+        self.metrics = metrics
+        self.zero_copy = reader.zero_copy
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        self.metrics.count_seek()
+        return self.reader.seek(pos, whence)
+
+    def tell(self):
+        return self.reader.tell()
+
+    def read(self, num_bytes):
+        data = self.reader.read(num_bytes)
+        self.metrics.count_read(len(data))
+        return data
+
+    def read_at(self, offset, num_bytes):
+        data = self.reader.read_at(offset, num_bytes)
+        self.metrics.count_read(len(data))
+        return data
+
+    def get_size(self):
+        return self.reader.get_size()
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def close(self):
+        self.reader.close()
+
+
+class HikCachedReader(HikPositionalReader):
+    """
+    Serves reads smaller than BULK_READ_SIZE from an LRU cache of extents of extent_size bytes,
+    aligned to their size, with at most cache_bytes cached. Bulk reads bypass the cache.
+    Placed above HikMeteredReader, so the metrics only count the reads reaching the image.
+    Hits and misses are counted in hits/misses and in metrics, if given.
+    """
+
+    def __init__(self, reader, extent_size=CACHE_EXTENT_SIZE, cache_bytes=CACHE_BYTES, metrics=None):
+        super().__init__(reader.filename)
+        if extent_size <= 0 or extent_size % 512:
+            raise ValueError("Extent size has to be a multiple of the 512 byte sector: {}".format(extent_size))
+        self.reader = reader
+        self.zero_copy = reader.zero_copy
+        self.extent_size = extent_size
+        self.cache_bytes = cache_bytes
+        self.metrics = metrics
+        self.extents = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def read_at(self, offset, num_bytes):
+        if num_bytes >= BULK_READ_SIZE:
+            return self.reader.read_at(offset, num_bytes)
+        parts = []
+        end = offset + num_bytes
+        while offset < end:
+            extent_offset = offset - offset % self.extent_size
+            part = self._get_extent(extent_offset)[offset - extent_offset:end - extent_offset]
+            if not part:
+                break
+            parts.append(part)
+            offset += len(part)
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+    def _get_extent(self, extent_offset):
+        with self.lock:
+            extent = self.extents.get(extent_offset)
+            if extent is not None:
+                self.extents.move_to_end(extent_offset)
+                self.hits += 1
+        if self.metrics is not None:
+            self.metrics.count_cache(extent is not None)
+        if extent is not None:
+            return extent
+        extent = bytes(self.reader.read_at(extent_offset, self.extent_size))
+        with self.lock:
+            self.misses += 1
+            if extent_offset not in self.extents:
+                self.extents[extent_offset] = extent
+                self.cached_bytes += len(extent)
+            while self.cached_bytes > self.cache_bytes and self.extents:
+                _, evicted = self.extents.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+        return extent
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "extent_size": self.extent_size,
+            "cached_bytes": self.cached_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def get_size(self):
+        return self.reader.get_size()
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def close(self):
+        with self.lock:
+            self.extents.clear()
+            self.cached_bytes = 0
+        self.reader.close()
+
+
+def open_reader(filename, backend="file"):
+    """
+    Opens the image with the requested backend ("file", "mmap" or "direct").
+    Falls back to the file backend if the image can not be mapped, e.g. raw devices,
+    or the file system does not support direct I/O.
+    Split images (image.001, image.002, ...) are detected and read as one image by HikSegmentReader,
+    gzip compressed images are read by HikGzipReader.
+    """
+    if backend not in ("file", "mmap", "direct"):
+        raise ValueError("Unknown reader backend: {}".format(backend))
+    # Imported here, hikcompressed builds on HikReader
+    from .hikcompressed import is_gzip, HikGzipReader
+    if is_gzip(filename):
+        return HikGzipReader(filename)
+    segments = find_segments(filename)
+    if len(segments) > 1:
+        logging.info("Split image with %d segments, reading %s to %s", len(segments), segments[0], segments[-1])
+        return HikSegmentReader(segments)
+    if backend == "direct":
+        try:
+            return HikDirectReader(filename)
+        except OSError as e:
+            logging.info("Direct I/O on %s not possible (%s), using file reader", filename, e)
+    elif backend == "mmap":
+        try:
+            return HikMmapReader(filename)
+        except (OSError, ValueError) as e:
+            logging.info("Memory mapping of %s not possible (%s), using file reader", filename, e)
+    return HikFileReader(filename)
@@ -0,0 +1,173 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+import os
+import datetime
+import logging
+from .hikhasher import HikHasher
+from .hikindex import format_time, SECONDS_PER_DAY
+from .hikextractor import HikExtractor, CHUNK_SIZE
+
+STITCH_MANIFEST_NAME = "HIKStitched.csv"
+# Blocks starting later than this many seconds after the end of the previous block begin a new segment
+MAX_GAP = 1
+
+
+class HikStitcher(HikExtractor):
+    """
+    Writes the data blocks of every channel, ordered by start time, into one continuous file per channel
+    (per channel and day with per_day) instead of one file per block.
+
+    A sidecar "<file>.csv" maps the time range of every block to its byte offset in the stitched file.
+    Blocks which do not continue the recording of the previous block start a new segment.
+    Only the valid stream of every block is stitched by default (trim), a full block would put its stale
+    tail between the recordings.
+    The channels are distributed over the workers, every stitched file is written by one worker.
+    Digests, resume and cancel work per stitched file like HikExtractor does per block.
+    """
+
+    def __init__(self, parser, workers=1, max_buffers=None, chunk_size=CHUNK_SIZE, hash_algorithms=("md5",),
+                 resume=True, trim=True, payload_sizes=None, cancel_event=None, per_day=False, reserve_space=None):
+        super().__init__(parser, workers, max_buffers, chunk_size, hash_algorithms=hash_algorithms, resume=resume,
+                         trim=trim, payload_sizes=payload_sizes, cancel_event=cancel_event,
+                         reserve_space=reserve_space)
+        self.per_day = per_day
+
+    def group_rows(self, rows):
+        """ Maps (channel, day) to the rows of the stitched file sorted by start time, day is None without per_day."""
+        table = self.parser.block_table
+        groups = {}
+        for row in rows:
+            day = table.start_time[row] // SECONDS_PER_DAY if self.per_day else None
+            groups.setdefault((table.channel[row], day), []).append(row)
+        for group in groups.values():
+            group.sort(key=lambda row: (table.start_time[row], table.data_offset[row]))
+        return groups
+
+    def stitch_file_name(self, channel, day):
+        """ Output file name (without extension) of a stitched channel."""
+        if day is None:
+            return "ch_{}".format(channel)
+        date = datetime.date(1970, 1, 1) + datetime.timedelta(days=day)
+        return "ch_{}_{}".format(channel, date.strftime('%Y-%m-%d'))
+
+    def extract(self, dir, rows=None, order=None):
+        """ Stitches the given block table rows, all blocks if rows is None. Returns the stitched file names."""
+        table = self.parser.block_table
+        if rows is None:
+            rows = range(len(table))
+        groups = self.group_rows(rows)
+        logging.info("Stitching %d data blocks into %d files", sum(len(group) for group in groups.values()),
+                     len(groups))
+
+        total_blocks = sum(len(group) for group in groups.values())
+        self.parser.metrics.notify("extract_start", total_blocks=total_blocks,
+                                   total_bytes=total_blocks * self.parser.master_sector.data_block_size)
+        self.start(dir)
+        try:
+            self._run_jobs(self.extract_group, dir, sorted(groups.items()))
+        finally:
+            self.finish()
+        return [self.stitch_file_name(channel, day) + ".mp4" for channel, day in sorted(groups)]
+
+    def open_manifest(self, dir):
+        self.manifest = open(os.path.join(dir, STITCH_MANIFEST_NAME), "w", newline="")
+        self.manifest.write(";".join(("File", "Channel", "Blocks", "Segments", "Starttime", "Endtime", "Size")
+                                     + self.hash_algorithms) + "\n")
+
+    def write_stitch_manifest(self, fileName, channel, rows, segments, size, digests):
+        if self.manifest is None:
+            return
+        table = self.parser.block_table
+        output = ";".join([
+            os.path.basename(fileName),
+            str(channel),
+            str(len(rows)),
+            str(segments),
+            format_time(min(table.start_time[row] for row in rows)),
+            format_time(max(table.end_time[row] for row in rows)),
+            str(size)
+        ] + [digests[name] for name in self.hash_algorithms])
+        with self.manifest_lock:
+            self.manifest.write(output + "\n")
+            self.manifest.flush()
+
+    def write_index(self, indexName, index):
+        """ Writes the sidecar index, entries are (segment, page, block, start, end, offset, size, source offset)."""
+        tmp_path = indexName + ".tmp"
+        with open(tmp_path, "w", newline="") as file:
+            file.write("Segment;Page;Datablock;Starttime;Endtime;Offset;Size;Sourceoffset\n")
+            file.writelines("{};{};{};{};{};{};{};{}\n".format(
+                segment, page, block, format_time(start_time), format_time(end_time), offset, size, source_offset)
+                for segment, page, block, start_time, end_time, offset, size, source_offset in index)
+        os.replace(tmp_path, indexName)
+
+    def extract_group(self, dir, item):
+        (channel, day), rows = item
+        table = self.parser.block_table
+        fileName = os.path.join(dir, self.stitch_file_name(channel, day)) + ".mp4"
+        indexName = os.path.splitext(fileName)[0] + ".csv"
+
+        if self.resume and self.journal is not None and os.path.isfile(indexName):
+            completed = self.journal.get_completed(fileName, self.hash_algorithms)
+            index = self.read_index(indexName)
+            # The stitched file is only reused if it holds exactly the selected blocks
+            if completed is not None and [entry[7] for entry in index] == [table.data_offset[row] for row in rows]:
+                size, digests = completed
+                self.write_stitch_manifest(fileName, channel, rows, index[-1][0], size, digests)
+                for row, entry in zip(rows, index):
+                    self.parser.metrics.block_skipped(table.get_entry(row), entry[6])
+                logging.info("Channel %s already stitched into %s", channel, os.path.basename(fileName))
+                return fileName
+
+        # The index is written before the stitched file is renamed, a complete file always has its index
+        partName = fileName + ".part"
+        hasher = HikHasher(self.hash_algorithms, metrics=self.parser.metrics)
+        index = []
+        segment = 0
+        recorded_until = None
+        try:
+            with open(partName, 'wb') as f2:
+                for row in rows:
+                    block = table.get_entry(row)
+                    if recorded_until is None or block.start_time > recorded_until + MAX_GAP:
+                        segment += 1
+                    recorded_until = block.end_time if recorded_until is None else max(recorded_until,
+                                                                                       block.end_time)
+                    position = f2.tell()
+                    self.check_space(dir)
+                    size = self.copy_block(f2, block, hasher)
+                    index.append((segment, block.page_index + 1, block.block_index, block.start_time,
+                                  block.end_time, position, size, block.data_offset))
+                    self.parser.metrics.block_extracted(block, size)
+                size = f2.tell()
+                f2.flush()
+                os.fsync(f2.fileno())
+        finally:
+            digests = hasher.hexdigests()
+        self.write_index(indexName, index)
+        os.replace(partName, fileName)
+        if self.journal is not None:
+            self.journal.record(fileName, size, digests)
+        self.write_stitch_manifest(fileName, channel, rows, segment, size, digests)
+        logging.info("Channel %s: %d blocks stitched into %s", channel, len(index), os.path.basename(fileName))
+        return fileName
+
+    def read_index(self, indexName):
+        """ Reads the sidecar index back, times are not parsed and stay formatted."""
+        index = []
+        with open(indexName, "r", newline="") as file:
+            next(file)
+            for line in file:
+                fields = line.rstrip("\n").split(";")
+                index.append((int(fields[0]), int(fields[1]), int(fields[2]), fields[3], fields[4],
+                              int(fields[5]), int(fields[6]), int(fields[7])))
+        return index
@@ -0,0 +1,166 @@
+"""
+HIKVISION Video Data Recovery
+Author: Dane Wullen
+Date: 2020
+Version: 0.1
+NO WARRANTY, SOFWARE IS PROVIDED 'AS IS'
+
+
+© 2020 Dane Wullen
+"""
+
+# Start of a HIKVISION media file header and of an MPEG program stream pack header
+HIKVISION_HEADER = b"IMKH"
+HIKVISION_HEADER_SIZE = 40
+PS_PACK_HEADER = b"\x00\x00\x01\xba"
+PS_START_CODE = b"\x00\x00\x01"
+PS_END_CODE = 0xB9
+PS_SYSTEM_HEADER = 0xBB
+PROBE_SIZE = 1024 * 1024
+WINDOW_SIZE = 4 * 1024 * 1024
+# A pack whose SCR goes backwards or jumps further than this (90 kHz ticks) belongs to older footage
+MAX_SCR_STEP = 10 * 90000
+# Bytes a resync may scan for the next pack header, and the zero run that ends the stream
+MAX_RESYNC_SIZE = 256 * 1024
+ZERO_RUN_SIZE = 4096
+
+
+def read_scr(data, pos):
+    """ System clock reference (in 90 kHz ticks) of the MPEG-2 pack header at pos, None if not MPEG-2."""
+    b = data[pos + 4:pos + 10]
+    if len(b) < 6 or b[0] & 0xC0 != 0x40:
+        return None
+    return (((b[0] >> 3) & 0x07) << 30 | (b[0] & 0x03) << 28 | b[1] << 20 |
+            ((b[2] >> 3) & 0x1F) << 15 | (b[2] & 0x03) << 13 | b[3] << 5 | (b[4] >> 3) & 0x1F)
+
+
+class HikStreamWindow:
+    """
+    Forward only read window over length bytes at offset of an image reader, every byte is read once.
+    Released bytes are dropped from the window, or handed to sink in order if one is given.
+    length shrinks to the end of the image if the image ends inside the block.
+    """
+
+    def __init__(self, reader, offset, length, window_size=WINDOW_SIZE, sink=None):
+        self.reader = reader
+        self.offset = offset
+        self.length = length
+        self.window_size = window_size
+        self.sink = sink
+        # Position of buffer[0] relative to the block
+        self.base = 0
+        self.buffer = bytearray()
+
+    def _fill(self, end):
+        while self.base + len(self.buffer) < min(end, self.length):
+            pos = self.base + len(self.buffer)
+            data = self.reader.read_at(self.offset + pos, min(self.window_size, self.length - pos))
+            if not data:
+                self.length = pos
+                break
+            self.buffer += data
+
+    def get(self, pos, size):
+        """ size bytes at pos relative to the block, shorter at the end of the block."""
+        self._fill(pos + size)
+        return bytes(self.buffer[pos - self.base:pos - self.base + size])
+
+    def find(self, pattern, pos, limit):
+        """ Position of the next pattern between pos and limit relative to the block, -1 if there is none."""
+        while True:
+            end = min(limit, self.length)
+            self._fill(min(end, pos + self.window_size))
+            available = min(end, self.base + len(self.buffer))
+            found = self.buffer.find(pattern, pos - self.base, available - self.base)
+            if found >= 0:
+                return self.base + found
+            if available >= end:
+                return -1
+            # A pattern may span the end of the bytes searched so far
+            pos = max(pos, available - len(pattern) + 1)
+
+    def release(self, pos, force=False):
+        """ Drops the bytes before pos, in pieces of at least window_size unless forced."""
+        count = pos - self.base
+        if count <= 0 or (count < self.window_size and not force):
+            return
+        if self.sink is not None:
+            self.sink(bytes(self.buffer[:count]))
+        del self.buffer[:count]
+        self.base = pos
+
+    def drain(self, end):
+        """ Reads and releases everything up to end, returns the position reached."""
+        while True:
+            self._fill(min(end, self.base + len(self.buffer) + self.window_size))
+            reached = min(end, self.base + len(self.buffer))
+            self.release(reached, force=True)
+            if reached >= min(end, self.length):
+                return reached
+
+
+def packet_size(header):
+    """ Size of the program stream packet starting with header (16 bytes), None if it is no packet start."""
+    if len(header) < 6 or header[:3] != PS_START_CODE:
+        return None
+    stream_id = header[3]
+    if stream_id == 0xBA:
+        if header[4] & 0xC0 == 0x40:
+            # MPEG-2 pack header, stuffing length in the low bits of the last byte
+            if len(header) < 14:
+                return None
+            return 14 + (header[13] & 0x07)
+        return 12
+    if stream_id == PS_END_CODE:
+        return 4
+    if stream_id >= PS_SYSTEM_HEADER:
+        return 6 + (header[4] << 8 | header[5])
+    return None
+
+
+def find_stream_end(reader, offset, length, sink=None):
+    """
+    Length of the valid video stream in the data block of length bytes at offset.
+    The MPEG program stream is followed packet by packet from its start. Padding, resync gaps and corrupt
+    packets are skipped up to the next pack header within MAX_RESYNC_SIZE bytes. The stream ends at a zero
+    run, at a pack whose SCR goes backwards or jumps (older footage of a reused block) or after the last
+    complete packet. Blocks without a recognisable stream start are reported with their full length.
+    With sink the bytes of the stream are handed to sink in order while the block is read once.
+    """
+    window = HikStreamWindow(reader, offset, min(length, max(0, reader.get_size() - offset)), sink=sink)
+    head = window.get(0, PROBE_SIZE)
+    if head[:4] == HIKVISION_HEADER:
+        pos = HIKVISION_HEADER_SIZE
+    else:
+        pos = head.find(PS_PACK_HEADER)
+        if pos < 0:
+            return window.length if sink is None else window.drain(length)
+
+    start = pos
+    end = pos
+    last_scr = None
+    while pos + 6 <= window.length:
+        header = window.get(pos, 16)
+        size = packet_size(header)
+        if size is not None and pos + size <= window.length:
+            if header[3] == 0xBA:
+                scr = read_scr(header, 0)
+                if scr is not None:
+                    if last_scr is not None and not 0 <= scr - last_scr <= MAX_SCR_STEP:
+                        break
+                    last_scr = scr
+            pos += size
+            end = pos
+            window.release(end)
+            continue
+        # The footage may go on behind padding or a corrupt packet, but not behind zeros or long garbage
+        if not window.get(pos, ZERO_RUN_SIZE).strip(b"\0"):
+            break
+        pos = window.find(PS_PACK_HEADER, pos + 1, pos + MAX_RESYNC_SIZE)
+        if pos < 0:
+            break
+
+    if end == start:
+        return window.length if sink is None else window.drain(length)
+    window.release(end, force=True)
+    return end